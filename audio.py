@@ -1,5 +1,6 @@
 import time
 import os
+import struct
 
 import umidiparser
 
@@ -105,6 +106,37 @@ def midinumber_to_note(midinumber: int) -> str:
     return f"{note_name}{written_octave}"
 
 
+def find_wav_data_offset(f) -> int:
+    """
+    Locate the first PCM byte of a RIFF/WAVE file.
+
+    Walks the chunk list instead of assuming a fixed 44-byte header,
+    so files carrying LIST/INFO (or other) chunks are mixed correctly.
+
+    Args:
+        f: WAV file opened in binary mode.
+
+    Returns:
+        Byte offset of the `data` chunk payload,
+        or 44 if the header could not be parsed.
+    """
+    f.seek(0)
+    header = f.read(12)
+    if len(header) < 12 or header[0:4] != b'RIFF' or header[8:12] != b'WAVE':
+        return 44
+    offset = 12
+    while True:
+        chunk_header = f.read(8)
+        if len(chunk_header) < 8:
+            return 44
+        chunk_id, chunk_size = struct.unpack('<4sI', chunk_header)
+        offset += 8
+        if chunk_id == b'data':
+            return offset
+        offset += chunk_size + (chunk_size & 1)  # Chunks are word aligned
+        f.seek(offset)
+
+
 class Voice:
     def __init__(
             self,
@@ -125,6 +157,7 @@ class Voice:
         self.finished = finished
         self.active = active
         self.valid = valid
+        self.stream = None  # File streamed instead of loaded_data for notes registered with register_note_path
 
         # TODO:
         # self.sustain: Use algorithm for sustain
@@ -142,7 +175,10 @@ class Voice:
             finished: bool = False,
             active: bool = False,
             valid: bool = True,
+            stream = None,
         ):
+        if self.stream is not stream:
+            self.close_stream()
         self.voice_id = voice_id
         self.loaded_data = loaded_data
         self.current_pos = current_pos
@@ -151,8 +187,11 @@ class Voice:
         self.finished = finished
         self.active = active
         self.valid = valid
+        self.stream = stream
 
     def copy(self, voice: "Voice"):
+        if self.stream is not voice.stream:
+            self.close_stream()
         self.voice_id = voice.voice_id
         self.loaded_data = voice.loaded_data
         self.current_pos = voice.current_pos
@@ -161,6 +200,13 @@ class Voice:
         self.finished = voice.finished
         self.active = voice.active
         self.valid = voice.valid
+        self.stream = voice.stream
+        voice.stream = None  # The copy owns the file from now on and closes it when it finishes
+
+    def close_stream(self):
+        if self.stream is not None:
+            self.stream.close()
+            self.stream = None
 
 
 class Sampler:
@@ -179,6 +225,7 @@ class Sampler:
         self.volume_factor = volume_factor
         self.samples = {}  # Store sample filepath
         self.keys = []     # Store the keys (pitches) of the sample notes
+        self._data_offsets = {}  # Store {filename: data chunk offset}
         self.load_samples()
 
     def load_sample(self, filename, duration: Optional[float] = None):
@@ -186,7 +233,9 @@ class Sampler:
         Load sample file to memory
         """
         with open(f"{self.sample_dir}/{filename}", "rb") as f:
-            f.seek(44)  # Skip the WAV file header
+            if filename not in self._data_offsets:
+                self._data_offsets[filename] = find_wav_data_offset(f)
+            f.seek(self._data_offsets[filename])  # Skip the WAV file header
             if duration is not None and duration > 0:
                 # Calculate number of samples needed
                 num_samples_to_read = int(duration * self.rate)
@@ -244,11 +293,33 @@ class Sampler:
             sample //= int(1 / self.volume_factor)  # TODO: check memory fragment
         return sample
 
-    def pitch_shift(self, note, duration: Optional[float] = None):
+    def render_into(self, note, out, duration: float) -> int:
+        """
+        Render the audio data for a specified note into a caller-provided buffer, without temporary sample arrays
+        :param note: Target note name (e.g., A4, C#3)
+        :param out: bytearray receiving int16 samples, at least int(duration * rate) * 2 bytes
+        :return: Number of bytes written
+        """
+        if note in self.samples:
+            filename = self.samples[note]
+            with open(f"{self.sample_dir}/{filename}", "rb") as f:
+                if filename not in self._data_offsets:
+                    self._data_offsets[filename] = find_wav_data_offset(f)
+                f.seek(self._data_offsets[filename])  # Skip the WAV file header
+                num_bytes = f.readinto(memoryview(out)[:int(duration * self.rate) * 2])
+        else:
+            num_bytes = self.pitch_shift(note, duration=duration, out=out)
+        if self.volume_factor > 0:
+            sample = np.frombuffer(out, dtype=np.int16, count=num_bytes // 2)
+            sample //= int(1 / self.volume_factor)
+        return num_bytes
+
+    def pitch_shift(self, note, duration: Optional[float] = None, out: Optional[bytearray] = None):
         """
         Use pitch shifting to generate the target note
         :param note: Target note name (e.g., A4, C#3)
-        :return: Generated audio data (numpy array)
+        :param out: Optional bytearray to write the int16 samples into instead of allocating an array
+        :return: Generated audio data (numpy array), or the number of bytes written to out
         """
         # Find the closest sample note
         target_freq = self.note_to_frequency(note)
@@ -262,15 +333,19 @@ class Sampler:
 
         # Use numpy interpolation to achieve pitch shifting
         original_length = len(closest_sample)
+        # Every index below int(original_length / shift_factor) is in range, trimming to the duration
+        # before interpolating keeps the float temporaries at the output length
         new_length = int(original_length / shift_factor)
+        if duration is not None and duration > 0:
+            new_length = min(new_length, int(duration * self.rate))
         indices = np.arange(new_length) * shift_factor
-        indices = indices[indices < original_length]  # Ensure indices are within range
         shifted_sample = np.interp(indices, np.arange(original_length), closest_sample)
+        del indices
 
-        if duration is not None and duration > 0:
-            target_samples = int(duration * self.rate)
-            return np.array(shifted_sample[:target_samples], dtype=np.int16)
-
+        if out is not None:
+            num_samples = len(shifted_sample)
+            np.frombuffer(out, dtype=np.int16, count=num_samples)[:] = shifted_sample  # Converted to int16 on assignment
+            return num_samples * 2
         return np.array(shifted_sample, dtype=np.int16)
 
     def find_closest_sample(self, target_freq):
@@ -364,6 +439,9 @@ class AudioManager:
 
         # File Caching
         self._loaded_wavs: Dict[str, np.ndarray] = {} # Stores {filepath: bytearray_data}
+        self._data_offsets: Dict[str, int] = {} # Stores {filepath: data chunk offset}
+        self._note_paths: Dict[str, str] = {} # Stores {name: filepath} of notes streamed from flash
+        self._stream_chunks = None # Per active voice (bytes, np.int16) read buffers, allocated by register_note_path
 
         # Temporary NumPy buffer to compute volume
         self.volume_buffer_int16 = np.zeros(self.BUFFER_SAMPLES, dtype=np.int16)
@@ -405,9 +483,13 @@ class AudioManager:
         if wav_data is None:
             print(f"Loading '{wav_file}'...")
             with open(wav_file, "rb") as f:
-                f.seek(44) # Skip WAV header
-                wav_data = bytearray(f.read())  # TODO: use readinto
-                # loaded_np_array = np.fromfile(f, dtype=np.int16)
+                if wav_file not in self._data_offsets:
+                    self._data_offsets[wav_file] = find_wav_data_offset(f)
+                data_offset = self._data_offsets[wav_file]
+                f.seek(data_offset) # Skip WAV header
+                # Read straight into a buffer of the final size, avoiding a read() + bytearray() copy
+                wav_data = bytearray(os.stat(wav_file)[6] - data_offset)
+                f.readinto(wav_data)
         loaded_np_array = np.frombuffer(wav_data, dtype=np.int16)
         self._loaded_wavs[wav_file] = loaded_np_array
         print(f"Loaded '{wav_file}' ({loaded_np_array.size} np.int16).")
@@ -418,8 +500,20 @@ class AudioManager:
         # TODO: FIFO Dict
         self._loaded_wavs.pop(wav_file)
 
+    def register_note_path(self, name: str, path: str, data_offset: int = 0):
+        """Plays name by streaming raw int16 samples from path (starting at data_offset) instead of keeping them in memory.
+        The file is opened by play_note, so a missing file raises there, the I2S callback only reads from it."""
+        self._note_paths[name] = path
+        self._data_offsets[path] = data_offset
+        if self._stream_chunks is None:
+            chunks = []
+            for _ in range(self.max_voices):
+                chunk_bytes = bytearray(self.BUFFER_BYTES)
+                chunks.append((chunk_bytes, np.frombuffer(chunk_bytes, dtype=np.int16)))
+            self._stream_chunks = tuple(chunks)
+
     def _prepare_buffer(self, buffer_idx: int):
-        """Mixes active voices (from memory) using NumPy."""
+        """Mixes active voices using NumPy, from memory or by reading the next chunk of the file opened by play_note."""
         target_buffer_np = self.audio_buffers[buffer_idx]
         target_buffer_np -= target_buffer_np  # Clear target NumPy buffer
 
@@ -446,7 +540,8 @@ class AudioManager:
                 voice.active = True
 
         # Iterate through active voices [loaded_data, current_pos]
-        for voice_info in self.active_voices:
+        for voice_idx in range(self.max_voices):
+            voice_info = self.active_voices[voice_idx]
             if not voice_info.valid:
                 continue
             loaded_data = voice_info.loaded_data # The bytearray data
@@ -465,13 +560,23 @@ class AudioManager:
                     print(f"stopping '{voice_id}, {voice_id}' at {current_ms}.")
                 continue
 
-            # Get memory slice for the current chunk (np.int16)
-            num_read_samples = min(self.BUFFER_SAMPLES, loaded_data.size - current_pos)
+            if loaded_data is None:
+                # Streamed from flash, read the next chunk into this voice's buffer
+                chunk_bytes, chunk_int16 = self._stream_chunks[voice_idx]
+                num_read_samples = (voice_info.stream.readinto(chunk_bytes) or 0) // 2
+                reached_end = num_read_samples < self.BUFFER_SAMPLES
+            else:
+                # Get memory slice for the current chunk (np.int16)
+                num_read_samples = min(self.BUFFER_SAMPLES, loaded_data.size - current_pos)
+                reached_end = current_pos + num_read_samples >= loaded_data.size
 
             if num_read_samples > 0:
                 # Mix into the target buffer using NumPy addition
                 # Ensure slices match size
-                temp_int16_chunk = loaded_data[current_pos: current_pos + self.BUFFER_SAMPLES]
+                if loaded_data is None:
+                    temp_int16_chunk = chunk_int16[:num_read_samples]
+                else:
+                    temp_int16_chunk = loaded_data[current_pos: current_pos + self.BUFFER_SAMPLES]
                 # if self.volume_factor > 0:
                 #     self.volume_buffer_int16 -= self.volume_buffer_int16
                 #     if num_read_samples == self.BUFFER_SAMPLES:
@@ -495,7 +600,7 @@ class AudioManager:
                 voice_info.current_pos += num_read_samples
 
             # Check if this voice finished reading (reached end of loaded data)
-            if current_pos + num_read_samples >= loaded_data.size:
+            if reached_end:
                 # print(f"finished reading '{voice_id}'  at {current_ms}, {(current_pos, num_read_bytes, loaded_data.size)}")
                 voice_info.finished = True
 
@@ -503,6 +608,7 @@ class AudioManager:
         for active_voice in self.active_voices:
             if active_voice.finished:
                 active_voice.valid = False
+                active_voice.close_stream()
 
         self.valid_samples[buffer_idx] = total_samples_mixed
 
@@ -549,13 +655,22 @@ class AudioManager:
     def play_note(self, wav_file: str, nickname: Optional[str] = None, playtime: Optional[int] = None) -> int:
         """Plays a note (non-blocking). Adds the WAV file data (from cache) to active voices."""
 
-        # Ensure file is loaded into memory cache first
+        # Notes registered with register_note_path are streamed from flash while mixing
+        stream_path = self._note_paths.get(wav_file)
+
+        # Otherwise ensure file is loaded into memory cache first
         # load_wav will raise an error if file not found, stopping execution as requested
-        if wav_file not in self._loaded_wavs:
+        if stream_path is None and wav_file not in self._loaded_wavs:
             self.load_wav(wav_file)
 
-        # Get loaded data from cache
-        loaded_data = self._loaded_wavs[wav_file]
+        # Get loaded data from cache, or open the stream here so the I2S callback only has to read it
+        if stream_path is None:
+            loaded_data = self._loaded_wavs[wav_file]
+            stream = None
+        else:
+            loaded_data = None
+            stream = open(stream_path, "rb")
+            stream.seek(self._data_offsets[stream_path])
 
         # Add new voice with loaded data and start position 0
         # Position is in bytes
@@ -567,7 +682,7 @@ class AudioManager:
         for voice in self.added_voices:
             if not voice.valid:
                 voice.reinit(
-                    new_voice_id, loaded_data, 0, nickname or wav_file, time.ticks_ms(), valid=True
+                    new_voice_id, loaded_data, 0, nickname or wav_file, time.ticks_ms(), valid=True, stream=stream
                 )
                 self.voice_num += 1
                 if playtime is not None:
@@ -581,7 +696,7 @@ class AudioManager:
                 if oldest_voice.start_time > voice.start_time:
                     oldest_voice = voice
             oldest_voice.reinit(
-                new_voice_id, loaded_data, 0, nickname or wav_file, time.ticks_ms(), valid=True
+                new_voice_id, loaded_data, 0, nickname or wav_file, time.ticks_ms(), valid=True, stream=stream
             )
             new_voice_added = True
 
@@ -625,11 +740,13 @@ class AudioManager:
             # Active voices only contain data and position
             for voice in self.active_voices:
                 voice.valid = False
+                voice.close_stream()
             self.disabled_voices.clear()
             for voice in self.added_voices:
                 if voice.valid:
                     assert voice.active, f"Voice not actived before stop: {voice.voice_name}"
                 voice.valid = False
+                voice.close_stream()  # Opened by play_note but not handed to an active voice yet
 
             # Reset buffer state (NumPy buffers)
             audio_buffer_a, audio_buffer_b = self.audio_buffers
@@ -780,7 +897,8 @@ def midi_example():
     for note in ["C", "D", "E", "F", "G", "A", "A#", "B"]:
         for i in range(2, 6):
             if exists(f"{note_cache_path}/{note}"):
-                wav_data = open(f"{note_cache_path}/{note}", "rb").read()
+                with open(f"{note_cache_path}/{note}", "rb") as f:
+                    wav_data = f.read()
             else:
                 wav_data = sampler.get_sample(f"{note}{i}", duration=1.8).tobytes()
             audio_manager.load_wav(f"{note}{i}", wav_data)
@@ -0,0 +1,168 @@
+import struct
+import os
+
+from micropython import const
+
+
+# Paired device log record: sec_type, key length, value length, then key and value bytes.
+# A zero-length value is a tombstone for a deleted secret.
+_PAIRED_RECORD_HEADER = '<BHH'
+_PAIRED_RECORD_HEADER_SIZE = const(5)
+
+_ADV_FLAGS = b'\x02\x01\x06'  # General discoverable, BR/EDR not supported
+
+
+def build_adv_data(name: str = None, service_uuids: list = None, appearance: "Optional[int]" = None) -> bytes:
+    """Builds BLE advertising data from the flags, an optional appearance, the first 16-bit service UUID and the complete local name."""
+    head = _ADV_FLAGS
+    if appearance is not None:
+        head += struct.pack('<BBH', 3, 0x19, appearance)
+    if name and service_uuids:  # Common case, packed in a single call
+        encoded_name = name.encode('utf-8')
+        return struct.pack('<%dsBBHBB%ds' % (len(head), len(encoded_name)), head, 3, 0x03, service_uuids[0], 1 + len(encoded_name), 0x09, encoded_name)
+    parts = [head]
+    if service_uuids:
+        parts.append(struct.pack('<BBH', 3, 0x03, service_uuids[0]))
+    if name:
+        encoded_name = name.encode('utf-8')
+        parts.append(struct.pack('BB', 1 + len(encoded_name), 0x09) + encoded_name)
+    return b''.join(parts)
+
+
+class PairedKeyStore(object):
+    """Bonding secrets kept in a dict and persisted to an append-only binary log."""
+    def __init__(self, path: str, legacy_json_path: str = None):
+        self.path = path
+        self.legacy_json_path = legacy_json_path  # Older JSON store, imported into the log when the log does not exist yet
+        self._keys = None  # type: Optional[dict]  # Loaded on first use, so boot does not pay for it
+        self._pending = []  # type: list  # (sec_type, key, value) records waiting for flush()
+        self._record_num = 0
+        self._unsynced = False  # Records appended since the last os.sync()
+        self._cache = (None, None, None)  # Last looked up (sec_type, key, value)
+
+    @property
+    def keys(self) -> dict:
+        """Live secrets by (sec_type, key), the log is replayed on first access."""
+        if self._keys is None:
+            self.load()
+        return self._keys
+
+    def load(self) -> dict:
+        """Replays the log, the last record of each secret wins."""
+        keys = self._keys = {}
+        self._record_num = 0
+        try:
+            with open(self.path, 'rb') as f: data = f.read()
+        except OSError: return self._import_legacy_json()  # No log yet
+        try:
+            offset = 0
+            while offset + _PAIRED_RECORD_HEADER_SIZE <= len(data):
+                sec_type, key_len, value_len = struct.unpack_from(_PAIRED_RECORD_HEADER, data, offset)
+                offset += _PAIRED_RECORD_HEADER_SIZE
+                if offset + key_len + value_len > len(data):
+                    break  # Truncated record from an interrupted write
+                key = data[offset:offset + key_len]
+                offset += key_len
+                if value_len:
+                    keys[(sec_type, key)] = data[offset:offset + value_len]
+                else:
+                    keys.pop((sec_type, key), None)
+                offset += value_len
+                self._record_num += 1
+            print("Loaded paired devices.")
+        except Exception as e: print("Failed to load paired devices:", e); self._keys = {}; return self._keys
+        if self._record_num > 2 * len(keys):  # Mostly stale records, compact before they are replayed again
+            self.save()
+        return keys
+
+    def _import_legacy_json(self) -> dict:
+        """Moves the secrets of the older base64 JSON store into a new log, then removes the JSON file."""
+        keys = self._keys
+        if self.legacy_json_path is None:
+            return keys
+        try:
+            import json, binascii  # Only needed once, when upgrading from the JSON store
+            with open(self.legacy_json_path, 'r') as f: paired_device_data = json.load(f)
+        except OSError: return keys  # No older store either
+        except Exception as e: print("Failed to import paired devices:", e); return keys
+        try:
+            for sec_type, key, value in paired_device_data:
+                keys[(sec_type, binascii.a2b_base64(key))] = binascii.a2b_base64(value)
+        except Exception as e: print("Failed to import paired devices:", e); keys.clear(); return keys
+        if self.save():  # Only drop the JSON once the log was written
+            try: os.remove(self.legacy_json_path)
+            except OSError: pass
+        print(f"Imported {len(keys)} paired device secrets from {self.legacy_json_path}.")
+        return keys
+
+    def get(self, sec_type: int, key) -> "Optional[bytes]":
+        """Looks up a secret, key may be any bytes-like object."""
+        cached_sec_type, cached_key, cached_value = self._cache
+        if sec_type == cached_sec_type and cached_key == key:
+            return cached_value
+        if not isinstance(key, bytes): key = bytes(key)
+        value = self.keys.get((sec_type, key))
+        self._cache = (sec_type, key, value)
+        return value
+
+    def set(self, sec_type: int, key, value) -> bool:
+        """Stores or, when value is None, deletes a secret. Returns whether a record was queued for flush()."""
+        key = bytes(key)
+        if value is not None: value = bytes(value)
+        self._cache = (sec_type, key, value)  # The stack usually reads a secret back right after storing it
+        if value is None:
+            if self.keys.pop((sec_type, key), None) is None: return False
+            self._pending.append((sec_type, key, b''))
+            return True
+        if self.keys.get((sec_type, key)) == value: return False  # The stack often re-stores the same secret
+        self.keys[(sec_type, key)] = value
+        self._pending.append((sec_type, key, value))
+        return True
+
+    def flush(self) -> None:
+        """Appends the queued records to the log, compacting it when it grows too long. Call sync() to commit them."""
+        pending = self._pending
+        if not pending: return
+        try:
+            with open(self.path, 'ab') as f:
+                while pending:
+                    sec_type, key, value = pending.pop(0)
+                    f.write(struct.pack(_PAIRED_RECORD_HEADER, sec_type, len(key), len(value)))
+                    f.write(key)
+                    f.write(value)
+                    self._record_num += 1
+            self._unsynced = True
+        except Exception as e: print("Failed to save paired devices:", e); return
+        if self._record_num > 2 * len(self.keys):
+            self.save()
+
+    def save(self) -> bool:
+        """Rewrites the log as a compact snapshot of the live secrets. Returns whether it was written."""
+        tmp_path = self.path + ".tmp"
+        try:
+            with open(tmp_path, 'wb') as f:
+                for (sec_type, key), value in self.keys.items():
+                    f.write(struct.pack(_PAIRED_RECORD_HEADER, sec_type, len(key), len(value)))
+                    f.write(key)
+                    f.write(value)
+            os.rename(tmp_path, self.path)
+            os.sync()
+            self._unsynced = False
+            self._record_num = len(self.keys)
+            print("Paired devices saved.")
+            return True
+        except Exception as e: print("Failed to save paired devices:", e); return False
+
+    def sync(self) -> None:
+        """Commits appended records to flash, does nothing if there are none."""
+        if self._unsynced:
+            self._unsynced = False
+            os.sync()
+
+    def clear(self) -> None:
+        self._keys = {}
+        self._pending = []
+        self._record_num = 0
+        self._cache = (None, None, None)
+        try: os.remove(self.path); print("Cleared all paired device records.")
+        except OSError: print("No paired device records to clear.")
@@ -1,29 +1,59 @@
-import struct
 import time
 import bluetooth
-import json
-import os
-import binascii
 
-from typing import Dict, List
-from micropython import const
+from micropython import const, schedule
 from machine import Timer
 
-from utils import exists
+from ble_common import build_adv_data, PairedKeyStore
 from constants import KEYBOARD_REPORT_DESC, IO_CAPABILITY_NO_INPUT_OUTPUT, IRQ_CENTRAL_CONNECT, IRQ_CENTRAL_DISCONNECT, IRQ_GATTS_WRITE, IRQ_GATTS_READ_REQUEST, IRQ_ENCRYPTION_UPDATE, IRQ_GET_SECRET, IRQ_SET_SECRET, IRQ_MTU_EXCHANGED, IRQ_CONNECTION_UPDATE, FLAG_READ, FLAG_WRITE_NO_RESPONSE, FLAG_WRITE, FLAG_NOTIFY
 
 
+_DEBUG = const(0)  # Set to 1 to log BLE events; the prints are compiled out otherwise
+
+_ZEROS = b'\x00\x00\x00\x00\x00\x00'  # Clears unused key array slots
+
+_HID_SERVICE_UUID = bluetooth.UUID(0x1812)
+_HID_REPORT_MAP_UUID = bluetooth.UUID(0x2A4B)
+_HID_INFORMATION_UUID = bluetooth.UUID(0x2A4A)
+_HID_CONTROL_POINT_UUID = bluetooth.UUID(0x2A4C)
+_HID_INPUT_REPORT_UUID = bluetooth.UUID(0x2A4D)
+_CCC_DESCRIPTOR_UUID = bluetooth.UUID(0x2902)
+_REPORT_REF_DESCRIPTOR_UUID = bluetooth.UUID(0x2908)
+
+_LEGACY_PAIRED_DEVICES_PATH = "paired_devices.json"  # Bond store of earlier releases, migrated into the log on first load
+_PAIRED_SYNC_INTERVAL_MS = const(5000)  # At most one os.sync() for appended secrets per interval
+
+_HID_INFO_VALUE = b'\x11\x01\x00\x01'  # bcdHID 1.11, country code 0, flags: remote wake
+_INPUT_REF_VALUE = b'\x01\x01'  # Report ID 1, input report
+
+_HID_SERVICE_DEFINITION = (
+    _HID_SERVICE_UUID, (
+        (_HID_REPORT_MAP_UUID, FLAG_READ,),
+        (_HID_INFORMATION_UUID, FLAG_READ,),
+        (_HID_CONTROL_POINT_UUID, FLAG_WRITE_NO_RESPONSE,),
+        (_HID_INPUT_REPORT_UUID, FLAG_READ | FLAG_NOTIFY, (
+            (_CCC_DESCRIPTOR_UUID, FLAG_READ | FLAG_WRITE,),
+            (_REPORT_REF_DESCRIPTOR_UUID, FLAG_READ,),
+        )),
+    ),
+)
+
+
 class BluetoothKeyboard(object):
     """A Bluetooth HID keyboard implementation."""
     def __init__(
             self,
             device_name: str = "MicroKeyBoard",
-            paired_deivces_path: str = "paired_devices.json",
+            paired_deivces_path: str = "paired_devices.log",
         ):
         self.device_name = device_name
         self.paired_deivces_path = paired_deivces_path
+        self._adv_data = build_adv_data(name=device_name, service_uuids=[0x1812], appearance=0x03C1)  # Appearance: HID Keyboard
 
-        self.paired_device_keys = self._load_paired_device()
+        self.paired_devices = PairedKeyStore(paired_deivces_path, legacy_json_path=_LEGACY_PAIRED_DEVICES_PATH)
+        self._paired_sync_ms = time.ticks_ms()
+        self._flush_scheduled = False
+        self._scheduled_flush_cb = self._scheduled_flush  # Bound once, the IRQ must not allocate it
         self.ble = bluetooth.BLE()
         self._adv_timer = Timer(0)
 
@@ -31,69 +61,37 @@ class BluetoothKeyboard(object):
         self.report_handle = None
         self.cccd_handle = None
         self.notifications_enabled = False
-
-        self._HID_SERVICE_UUID = bluetooth.UUID(0x1812)
-        self._HID_REPORT_MAP_UUID = bluetooth.UUID(0x2A4B)
-        self._HID_INFORMATION_UUID = bluetooth.UUID(0x2A4A)
-        self._HID_CONTROL_POINT_UUID = bluetooth.UUID(0x2A4C)
-        self._HID_INPUT_REPORT_UUID = bluetooth.UUID(0x2A4D)
-        self._CCC_DESCRIPTOR_UUID = bluetooth.UUID(0x2902)
-        self._REPORT_REF_DESCRIPTOR_UUID = bluetooth.UUID(0x2908)
+        self._last_report_valid = False  # Whether _last_report holds what the host last received
+        self._connected_flag = None  # ThreadSafeFlag set from the IRQ when the host enables notifications, created by wait_connected
+
+        self._irq_handlers = {
+            IRQ_CENTRAL_CONNECT: self._on_connect,
+            IRQ_CENTRAL_DISCONNECT: self._on_disconnect,
+            IRQ_CONNECTION_UPDATE: self._on_connection_update,
+            IRQ_GATTS_WRITE: self._on_write,
+            IRQ_GATTS_READ_REQUEST: self._on_read_request,
+            IRQ_ENCRYPTION_UPDATE: self._on_encryption_update,
+            IRQ_GET_SECRET: self._on_get_secret,
+            IRQ_SET_SECRET: self._on_set_secret,
+            IRQ_MTU_EXCHANGED: self._on_mtu_exchanged,
+        }
 
         self._KEY_ARRAY_LEN = const(6)  # Size of HID key array, must match report descriptor
         self._KEY_REPORT_LEN = const(self._KEY_ARRAY_LEN + 2)  # Modifier Byte + Reserved Byte + Array entries
-
-    def _build_adv_data(self, name: str = None, service_uuids: List[int] = None) -> bytes:
-        parts = []
-        # Flags: BLE limited discovery mode, BR/EDR not supported
-        parts.append(b'\x02\x01\x06')
-        # Appearance: HID Keyboard (0x03C1)
-        # AD Type 0x19 is Appearance
-        # Length is 2 bytes (0x03C1) + 1 byte (Type) = 3 bytes total.
-        # Value 0x03C1 is little-endian: \xc1\x03
-        parts.append(b'\x03\x19\xc1\x03') # <-- Added this line
-
-        if service_uuids:
-            for uuid in service_uuids:
-                uuid_bytes = struct.pack('<H', uuid)
-                svc_part = struct.pack('BB', 1 + len(uuid_bytes), 0x03) + uuid_bytes
-                parts.append(svc_part)
-                break
-        if name:
-            encoded_name = name.encode('utf-8')
-            name_header = struct.pack('BB', 1 + len(encoded_name), 0x09)
-            parts.append(name_header + encoded_name)
-        return b''.join(parts)
-
-    def _save_paired_device(self) -> None:
-        try:
-            paired_device_data = [
-                [sec_type, binascii.b2a_base64(key).decode(), binascii.b2a_base64(value).decode()]
-                for (sec_type, key), value in self.paired_device_keys.items()
-            ]
-            with open(self.paired_deivces_path, 'w') as f: json.dump(paired_device_data, f)
-            os.sync()
-            print("Paired devices saved.")
-        except Exception as e: print("Failed to save paired devices:", e)
-
-    def _load_paired_device(self) -> Dict:
-        if not exists(self.paired_deivces_path): return {}
-        try:
-            keys_dict = {}
-            with open(self.paired_deivces_path, 'r') as f: paired_device_data = json.load(f)
-            print("Loaded paired devices.")
-            for sec_type, key, value in paired_device_data:
-                keys_dict[(sec_type, binascii.a2b_base64(key))] = binascii.a2b_base64(value)
-            return keys_dict
-        except Exception as e: print("Failed to load paired devices:", e); return {}
+        self._report_buf = bytearray(self._KEY_REPORT_LEN)
+        self._report_end = 2  # End of the key slots used by the last report, the rest are zero
+        self._last_report = bytearray(self._KEY_REPORT_LEN)
+
+    def flush_paired_devices(self, force_sync: bool = False) -> None:
+        """Writes secrets queued by IRQ_SET_SECRET, call this from the main loop."""
+        self.paired_devices.flush()
+        now = time.ticks_ms()
+        if force_sync or time.ticks_diff(now, self._paired_sync_ms) >= _PAIRED_SYNC_INTERVAL_MS:
+            self._paired_sync_ms = now
+            self.paired_devices.sync()
 
     def clear_paired_devices(self) -> None:
-        try: 
-            self.paired_device_keys = {}
-            os.remove(self.paired_deivces_path)
-            print("Cleared all paired device records.")
-        except OSError:
-            print("No paired device records to clear.")
+        self.paired_devices.clear()
 
     def send_report(self, report: bytes):
         if self.conn_handle is None or self.report_handle is None:
@@ -107,105 +105,173 @@ class BluetoothKeyboard(object):
             return False
 
     def send_keys(self, down_keys):
-        """Sends a HID keyboard report."""
-        modifiers, keycodes = 0, []
+        """Sends a HID keyboard report, negative codes in down_keys are modifiers (USB interface convention)."""
+        if not self.notifications_enabled:  # Host has not subscribed, skip building the report
+            return False
+        report = self._report_buf
+        modifiers, end = 0, 2
         for k in down_keys:
             if k < 0:  # Modifier key
                 modifiers |= -k
-            elif len(keycodes) < self._KEY_ARRAY_LEN:
-                keycodes.append(k)
-            else:
-                modifiers = 0
-                keycodes = []
+            elif end < self._KEY_REPORT_LEN:
+                report[end] = k
+                end += 1
+            else:  # Too many keys, report none
+                report[2:end] = _ZEROS[:end - 2]
+                modifiers, end = 0, 2
                 break
-        keycodes = keycodes + [0] * (self._KEY_ARRAY_LEN - len(keycodes))
-        report = struct.pack('BB6B', modifiers, 0, *keycodes)
-        return self.send_report(report)
+        report[0] = modifiers
+        return self._send_report_buf(end)
+
+    def send_modifier_keys(self, modifier_mask: int, keycodes: list):
+        """Sends a HID keyboard report from a modifier bitmask and up to 6 keycodes."""
+        if not self.notifications_enabled:
+            return False
+        report = self._report_buf
+        num_keys = len(keycodes)
+        if num_keys > self._KEY_ARRAY_LEN:  # Too many keys, report none
+            modifier_mask, num_keys = 0, 0
+        report[0] = modifier_mask
+        for i in range(num_keys):
+            report[2 + i] = keycodes[i]
+        return self._send_report_buf(2 + num_keys)
+
+    def _send_report_buf(self, end: int):
+        """Clears the key slots the previous report used past end, then notifies the report buffer if it changed."""
+        report = self._report_buf
+        if end < self._report_end:
+            report[end:self._report_end] = _ZEROS[:self._report_end - end]
+        self._report_end = end
+        if self._last_report_valid and report == self._last_report:  # Same as the last report sent, nothing to notify
+            return True
+        if not self.send_report(report):
+            return False
+        self._last_report[:] = report  # Copied in place, sending a report allocates nothing
+        self._last_report_valid = True
+        return True
 
     def _ble_irq(self, event: int, data: tuple) -> None:
         """Handles BLE IRQ events."""
-        if event == IRQ_CENTRAL_CONNECT:
-            self.conn_handle, addr_type, addr = data
-            self.notifications_enabled = False
-            print("[Connect] Connected to:", binascii.hexlify(addr).decode())
-        elif event == IRQ_CONNECTION_UPDATE:
-            self.conn_handle, conn_interval, conn_latency, supervision_timeout, status = data
+        handler = self._irq_handlers.get(event)
+        if handler is not None:
+            return handler(data)
+        if _DEBUG:
+            print(f"Unhandled event: {event}")
+
+    def _on_connect(self, data: tuple) -> None:
+        self.conn_handle, addr_type, addr = data
+        self.notifications_enabled = False
+        if _DEBUG:
+            print("[Connect] Connected to:", bytes(addr).hex())
+
+    def _on_connection_update(self, data: tuple) -> None:
+        self.conn_handle, conn_interval, conn_latency, supervision_timeout, status = data
+        if _DEBUG:
             interval_ms = conn_interval * 1.25
             timeout_ms = supervision_timeout * 1.25
             print(f"[New Parameters] Interval={interval_ms:.2f} ms, Latency={conn_latency}, Timeout={timeout_ms:.2f} ms, Status={status}")
-        elif event == IRQ_CENTRAL_DISCONNECT:
-            conn_handle_old, addr_type, addr = data
-            print("[Disconnect] Disconnected from:", binascii.hexlify(addr).decode())
-            self.conn_handle = None
-            self.notifications_enabled = False
-            self.ble.gap_advertise(None)
-            # time.sleep_ms(200)
-            # self._start_advertising()
-            self._adv_timer.init(mode=Timer.ONE_SHOT, period=200, callback=lambda t: self._start_advertising())
-        elif event == IRQ_GATTS_WRITE:
-            conn_handle_write, attr_handle = data
+
+    def _on_disconnect(self, data: tuple) -> None:
+        conn_handle_old, addr_type, addr = data
+        if _DEBUG:
+            print("[Disconnect] Disconnected from:", bytes(addr).hex())
+        self.conn_handle = None
+        self.notifications_enabled = False
+        self._last_report_valid = False  # Resend the full state after reconnecting
+        self.ble.gap_advertise(None)
+        self._adv_timer.init(mode=Timer.ONE_SHOT, period=200, callback=self._adv_timer_cb)
+
+    def _on_write(self, data: tuple) -> None:
+        conn_handle_write, attr_handle = data
+        if _DEBUG:
             print(f"_IRQ_GATTS_WRITE: conn={conn_handle_write}, handle={attr_handle}")
-            if attr_handle == self.cccd_handle:
-                try:
-                    value_written = self.ble.gatts_read(attr_handle)
-                    print(f"  Value written to CCCD handle {attr_handle}: {value_written}")
-                    if value_written == b'\x01\x00':
-                        print("  Notifications ENABLED by host.")
-                        self.notifications_enabled = True
-                    elif value_written == b'\x00\x00':
-                        print("  Notifications DISABLED by host.")
-                        self.notifications_enabled = False
-                    else:
-                        print("  Unknown value written to CCCD.")
-                        self.notifications_enabled = False
-                except Exception as e:
-                    print(f"  Could not read value written to CCCD handle {attr_handle}: {e}")
-                    self.notifications_enabled = False
-            else:
+        if attr_handle != self.cccd_handle:
+            if _DEBUG:
                 print("  Write was to a different handle.")
-        elif event == IRQ_GATTS_READ_REQUEST:
+            return
+        try:
+            value_written = self.ble.gatts_read(attr_handle)
+            if _DEBUG:
+                print(f"  Value written to CCCD handle {attr_handle}: {value_written}")
+            if value_written == b'\x01\x00':
+                if _DEBUG:
+                    print("  Notifications ENABLED by host.")
+                self.notifications_enabled = True
+                if self._connected_flag is not None:
+                    self._connected_flag.set()
+            elif value_written == b'\x00\x00':
+                if _DEBUG:
+                    print("  Notifications DISABLED by host.")
+                self.notifications_enabled = False
+            else:
+                if _DEBUG:
+                    print("  Unknown value written to CCCD.")
+                self.notifications_enabled = False
+        except Exception as e:
+            print(f"  Could not read value written to CCCD handle {attr_handle}: {e}")
+            self.notifications_enabled = False
+
+    def _on_read_request(self, data: tuple) -> None:
+        if _DEBUG:
             conn_handle_read, attr_handle = data
             print(f"_IRQ_GATTS_READ_REQUEST: conn={conn_handle_read}, handle={attr_handle}")
-            return None
-        elif event == IRQ_ENCRYPTION_UPDATE:
+        return None
+
+    def _on_encryption_update(self, data: tuple) -> None:
+        if _DEBUG:
             conn_handle_enc, encrypted, authenticated, bonded_status, key_size = data
             print(f"Encryption state: encrypted={encrypted}, authenticated={authenticated}, bonded={bonded_status}")
-        elif event == IRQ_GET_SECRET:
-            sec_type, index, key = data; key = bytes(key) if key is not None else None
-            if key is None: return None
-            if self.paired_device_keys and (sec_type, key) in self.paired_device_keys:
-                return self.paired_device_keys[(sec_type, key)]
-            return None
-        elif event == IRQ_SET_SECRET:
-            sec_type, key, value = data
-            key = bytes(key) if key is not None else None
-            value = bytes(value) if value is not None else None
-            if value is None:
-                self.paired_device_keys.pop((sec_type, key), None)
-                self._save_paired_device()
-                return True
-            else:
-                self.paired_device_keys[(sec_type, key)] = value
-                self._save_paired_device()
-                return True
-        elif event == IRQ_MTU_EXCHANGED:
+
+    def _on_get_secret(self, data: tuple):
+        sec_type, index, key = data
+        if key is None: return None
+        return self.paired_devices.get(sec_type, key)
+
+    def _on_set_secret(self, data: tuple) -> bool:
+        sec_type, key, value = data
+        if key is None: return False
+        if self.paired_devices.set(sec_type, key, value) and not self._flush_scheduled:  # Written outside the IRQ
+            try:
+                schedule(self._scheduled_flush_cb, None)
+                self._flush_scheduled = True
+            except RuntimeError: pass  # Schedule queue full, flush_paired_devices() picks it up
+        return True
+
+    def _scheduled_flush(self, _) -> None:
+        """Appends the secrets queued by IRQ_SET_SECRET once the IRQ has returned, a burst of them shares one flush."""
+        self._flush_scheduled = False
+        self.paired_devices.flush()
+
+    def _on_mtu_exchanged(self, data: tuple) -> None:
+        if _DEBUG:
             conn_handle_mtu, mtu = data
             print(f"_IRQ_MTU_EXCHANGED: new MTU={mtu}")
-        else:
-            print(f"Unhandled event: {event}")
+
+    def _adv_timer_cb(self, timer) -> None:
+        self._start_advertising()
+        self.paired_devices.sync()  # Commit secrets from the finished connection
 
     def _start_advertising(self) -> None:
         """Starts BLE advertising."""
-        adv_data = self._build_adv_data(name=self.device_name, service_uuids=[0x1812])
         try:
-            self.ble.gap_advertise(interval_us=100000, adv_data=adv_data, connectable=True, resp_data=None)
-            print("Advertising started...")
+            self.ble.gap_advertise(interval_us=100000, adv_data=self._adv_data, connectable=True, resp_data=None)
+            if _DEBUG:
+                print("Advertising started...")
         except Exception as e:
             print(f"Failed to start advertising: {e}")
 
     def connected(self):
         return self.conn_handle is not None and self.notifications_enabled
 
+    async def wait_connected(self) -> None:
+        """Sleeps until a host connects and enables notifications, instead of polling connected()."""
+        if self._connected_flag is None:
+            import asyncio  # Only paid for by callers that wait, main.py never does
+            self._connected_flag = asyncio.ThreadSafeFlag()
+        while not self.connected():
+            await self._connected_flag.wait()
+        self.flush_paired_devices(force_sync=True)  # Commit the secrets from pairing
+
     def start(self):
         """Main execution method."""
         self.ble.active(True)
@@ -218,29 +284,16 @@ class BluetoothKeyboard(object):
 
         time.sleep_ms(100)  # TODO: use async or timer
 
-        hid_service_definition = (
-            self._HID_SERVICE_UUID, (
-                (self._HID_REPORT_MAP_UUID, FLAG_READ,),
-                (self._HID_INFORMATION_UUID, FLAG_READ,),
-                (self._HID_CONTROL_POINT_UUID, FLAG_WRITE_NO_RESPONSE,),
-                (self._HID_INPUT_REPORT_UUID, FLAG_READ | FLAG_NOTIFY, (
-                    (self._CCC_DESCRIPTOR_UUID, FLAG_READ | FLAG_WRITE,),
-                    (self._REPORT_REF_DESCRIPTOR_UUID, FLAG_READ,),
-                )),
-            ),
-        )
         print("Registering services...")
         try:
-            ( (h_report_map, h_hid_info, h_control_point, h_input_report, h_input_cccd, h_input_ref), ) = self.ble.gatts_register_services((hid_service_definition,))
+            ( (h_report_map, h_hid_info, h_control_point, h_input_report, h_input_cccd, h_input_ref), ) = self.ble.gatts_register_services((_HID_SERVICE_DEFINITION,))
             self.report_handle = h_input_report
             self.cccd_handle = h_input_cccd
             print(f"Services registered. Report Handle: {self.report_handle}, CCCD Handle: {self.cccd_handle}")
 
             self.ble.gatts_write(h_report_map, KEYBOARD_REPORT_DESC)
-            hid_info_value = struct.pack("<HBB", 0x0111, 0x00, 0x01)
-            self.ble.gatts_write(h_hid_info, hid_info_value)
-            input_ref_value = struct.pack("<BB", 1, 1)
-            self.ble.gatts_write(h_input_ref, input_ref_value)
+            self.ble.gatts_write(h_hid_info, _HID_INFO_VALUE)
+            self.ble.gatts_write(h_input_ref, _INPUT_REF_VALUE)
             print("Initial characteristic/descriptor values written.")
 
         except Exception as e: print(f"Error registering services or writing values: {e}")
@@ -251,13 +304,16 @@ class BluetoothKeyboard(object):
 
         try:
             mac_address = self.ble.config('mac')[1]
-            print("Device MAC Address:", ":".join(f"{b:02X}" for b in mac_address))
+            try: mac_str = mac_address.hex(':').upper()
+            except TypeError: mac_str = ":".join(f"{b:02X}" for b in mac_address)  # Port without the separator argument
+            print("Device MAC Address:", mac_str)
         except Exception as e: print(f"Could not get MAC address: {e}")
 
         print("Setup complete. Waiting for connections...")
 
     def stop(self):
         """Closes the Bluetooth connection and deactivates the radio."""
+        self.flush_paired_devices(force_sync=True)
         if self.ble.active():
             self.ble.active(False)
             print("Bluetooth radio deactivated.")
@@ -268,19 +324,17 @@ if __name__ == "__main__":
     keyboard = BluetoothKeyboard()
     keyboard.start()
 
+    import asyncio
     from usb.device.keyboard import KeyCode
     sequence = [KeyCode.M, KeyCode.I, KeyCode.C, KeyCode.R, KeyCode.O]
-
-    while True:
-        if keyboard.connected():
-            for keycode in sequence:
-                keyboard.send_keys([keycode])
-                time.sleep_ms(100)
-                keyboard.send_keys([])
-                time.sleep_ms(100)
-            break
-        else:
-            time.sleep_ms(200)
+    key_hold_ms = 15  # Press/release spacing, the stack queues the notifications until the next connection event
+
+    asyncio.run(keyboard.wait_connected())
+    for keycode in sequence:
+        keyboard.send_keys([keycode])
+        time.sleep_ms(key_hold_ms)
+        keyboard.send_keys([])
+        time.sleep_ms(key_hold_ms)
 
     input("Press to continue...")
 
@@ -1,4 +1,6 @@
+import os
 import time
+import struct
 
 from machine import Pin
 from machine import I2S
@@ -6,6 +8,25 @@ from typing import Optional
 from ulab import numpy as np
 
 
+def find_wav_data_offset(f) -> int:
+    """Returns the offset of the WAV `data` chunk payload, or 44 if the header can't be parsed."""
+    f.seek(0)
+    header = f.read(12)
+    if len(header) < 12 or header[0:4] != b'RIFF' or header[8:12] != b'WAVE':
+        return 44
+    offset = 12
+    while True:
+        chunk_header = f.read(8)
+        if len(chunk_header) < 8:
+            return 44
+        chunk_id, chunk_size = struct.unpack('<4sI', chunk_header)
+        offset += 8
+        if chunk_id == b'data':
+            return offset
+        offset += chunk_size + (chunk_size & 1)  # Chunks are word aligned
+        f.seek(offset)
+
+
 class AudioManager:
     # Define buffer size in samples
     # Based on user's BUFFER_BYTES = 4096 and bytes_per_sample = 2 (16-bit mono)
@@ -49,17 +70,22 @@ class AudioManager:
         self.max_voices = max_voices
         self.bytes_per_sample = (self.bits // 8) * (self.format + 1) # Should be 2
 
-        # Double buffers (NumPy int16 arrays)
-        self.audio_buffers = [
-            np.zeros(self.BUFFER_SAMPLES, dtype=np.int16),
-            np.zeros(self.BUFFER_SAMPLES, dtype=np.int16),
-        ]
+        # Double buffers (NumPy int16 arrays over byte buffers, so I2S writes need no copy)
+        self.audio_bytebuffers = (
+            memoryview(bytearray(self.BUFFER_BYTES)),
+            memoryview(bytearray(self.BUFFER_BYTES))
+        )
+        self.audio_buffers = (
+            np.frombuffer(self.audio_bytebuffers[0], dtype=np.int16),
+            np.frombuffer(self.audio_bytebuffers[1], dtype=np.int16)
+        )
         # Valid samples mixed into each buffer
         self.valid_samples = [0, 0]
         self.buffer_to_play_idx = 0 # Index of buffer to play next
 
         # File Caching
-        self._loaded_wavs = {} # Stores {filepath: bytearray_data}
+        self._loaded_wavs = {} # Stores {filepath: memoryview(bytearray_data)}
+        self._data_offsets = {} # Stores {filepath: data chunk offset}
 
         # Temp buffer for reading from file (bytes) and converting (int16)
         self.reading_buffer_bytes = bytearray(self.BUFFER_BYTES)
@@ -89,9 +115,15 @@ class AudioManager:
 
         print(f"Loading '{wav_file}'...")
         with open(wav_file, "rb") as f:
-            f.seek(44) # Skip WAV header
-            wav_data = bytearray(f.read())
-
+            if wav_file not in self._data_offsets:
+                self._data_offsets[wav_file] = find_wav_data_offset(f)
+            data_offset = self._data_offsets[wav_file]
+            f.seek(data_offset) # Skip WAV header
+            wav_data = bytearray(os.stat(wav_file)[6] - data_offset)
+            f.readinto(wav_data)
+
+        # Cache a memoryview so the IRQ mixer slices without wrapping the data again
+        wav_data = memoryview(wav_data)
         self._loaded_wavs[wav_file] = wav_data
         print(f"Loaded '{wav_file}' ({len(wav_data)} bytes).")
         return wav_data
@@ -99,57 +131,59 @@ class AudioManager:
     def _prepare_buffer(self, buffer_idx: int):
         """Mixes active voices (from memory) using NumPy."""
         target_buffer_np = self.audio_buffers[buffer_idx]
-        target_buffer_np[:] = 0 # Clear target NumPy buffer
+        target_bytes_mv = self.audio_bytebuffers[buffer_idx]
 
         total_samples_mixed = 0
-        voices_finished_this_chunk = []
+        mixed_voices = 0
+        survivors = []
 
         # Iterate through active voices [loaded_data, current_pos_bytes]
-        i = 0
-        while i < len(self.active_voices):
-            voice_info = self.active_voices[i]
-            loaded_data = voice_info[0] # The bytearray data
+        for voice_info in self.active_voices:
+            loaded_data = voice_info[0] # The memoryview over cached PCM data
             current_pos_bytes = voice_info[1] # Current read position in bytes
             voice_name = voice_info[2]
             start_time = voice_info[3]
 
             # Get memory slice for the current chunk (bytes)
-            chunk_bytes_mv = memoryview(loaded_data)[current_pos_bytes : current_pos_bytes + self.BUFFER_BYTES]
+            chunk_bytes_mv = loaded_data[current_pos_bytes : current_pos_bytes + self.BUFFER_BYTES]
             num_read_bytes = len(chunk_bytes_mv)
-            num_read_samples = num_read_bytes // self.bytes_per_sample if self.bytes_per_sample > 0 else 0
+            num_read_samples = num_read_bytes // self.bytes_per_sample
 
             if num_read_samples > 0:
-                # Convert bytes chunk (memoryview) to int16 NumPy array
-                # Assumes np.frombuffer works on memoryview
-                temp_int16_chunk = np.frombuffer(chunk_bytes_mv, dtype=np.int16)
-
-                # Mix into the target buffer using NumPy addition
-                # Ensure slices match size
-                target_buffer_np[:num_read_samples] += temp_int16_chunk[:num_read_samples]
+                if mixed_voices == 0:
+                    # First voice is copied as-is, only the tail needs clearing
+                    target_bytes_mv[:num_read_samples * self.bytes_per_sample] = chunk_bytes_mv[:num_read_samples * self.bytes_per_sample]
+                    if num_read_samples < self.BUFFER_SAMPLES:
+                        target_buffer_np[num_read_samples:] = 0
+                else:
+                    # Convert bytes chunk (memoryview) to int16 NumPy array
+                    # Assumes np.frombuffer works on memoryview
+                    temp_int16_chunk = np.frombuffer(chunk_bytes_mv, dtype=np.int16)
+
+                    # Mix into the target buffer using NumPy addition
+                    # Ensure slices match size
+                    target_buffer_np[:num_read_samples] += temp_int16_chunk[:num_read_samples]
+                mixed_voices += 1
 
                 total_samples_mixed = max(total_samples_mixed, num_read_samples)
                 # Update position for this voice (in bytes)
                 voice_info[1] += num_read_bytes
 
-
-            # Check if this voice finished reading (reached end of loaded data)
+            # Keep the voice unless it reached the end of its data or was stopped
             if current_pos_bytes + num_read_bytes >= len(loaded_data):
-                voices_finished_this_chunk.append(i)
+                continue
             if voice_name in self.disabled_voices and self.disabled_voices[voice_name] > start_time:
-                voices_finished_this_chunk.append(i)
-
-            i += 1
-
-        # Remove finished voices
-        for i in sorted(voices_finished_this_chunk, reverse=True):
-             if i < len(self.active_voices):
-                 del self.active_voices[i]
+                continue
+            survivors.append(voice_info)
 
+        self.active_voices = survivors
+        if mixed_voices == 0:
+            target_buffer_np[:] = 0 # Clear target NumPy buffer
         self.valid_samples[buffer_idx] = total_samples_mixed
         self._all_voices_fully_processed = not self.active_voices
 
-        # Apply Clipping to the mixed buffer (NumPy)
-        if total_samples_mixed > 0:
+        # Apply Clipping to the mixed buffer (NumPy), a single voice needs none
+        if mixed_voices > 1:
             # Apply clip to the relevant slice of the target buffer
             self.audio_buffers[buffer_idx][:total_samples_mixed] = np.clip(
                 self.audio_buffers[buffer_idx][:total_samples_mixed],
@@ -167,9 +201,8 @@ class AudioManager:
 
         # Write the prepared buffer to I2S if it has data
         if samples_to_play > 0:
-            # Convert NumPy int16 slice to bytes
-            # Assumes ndarray.tobytes() exists
-            byte_data = self.audio_buffers[play_idx][:samples_to_play].tobytes()
+            # Slice the memoryview backing the NumPy buffer, no bytes copy
+            byte_data = self.audio_bytebuffers[play_idx][:samples_to_play * self.bytes_per_sample]
             self.audio_out.write(byte_data)
 
         # Update state for the next IRQ
@@ -193,12 +226,9 @@ class AudioManager:
         # Get loaded data from cache
         loaded_data = self._loaded_wavs[wav_file]
 
-        # Max voices check
+        # Max voices check, drop the oldest voice
         if len(self.active_voices) >= self.max_voices:
-            if self.active_voices:
-                # Oldest voice is [loaded_data, current_pos_bytes]
-                oldest_voice = self.active_voices.pop(0)
-                # No file object to close
+            self.active_voices.pop(0)
 
         # Add new voice with loaded data and start position 0
         # Position is in bytes
@@ -219,8 +249,8 @@ class AudioManager:
             # when the I2S buffer needs data after this write.
             samples_to_write_init = self.valid_samples[0]
             if samples_to_write_init > 0:
-                # Convert NumPy int16 slice to bytes for initial write
-                byte_data_init = self.audio_buffers[0][:samples_to_write_init].tobytes()
+                # Slice the memoryview backing the NumPy buffer for the initial write
+                byte_data_init = self.audio_bytebuffers[0][:samples_to_write_init * self.bytes_per_sample]
                 self.audio_out.write(byte_data_init)
                 self.buffer_to_play_idx = 1 # Next IRQ plays buffer 1
             else:
@@ -1,12 +1,12 @@
-import struct
 import time
 import bluetooth
-import json
-import os
-import binascii
 
-from typing import Dict, List
 from micropython import const
+from machine import Timer
+
+from ble_common import PairedKeyStore
+
+_DEBUG = const(0)  # Set to 1 to log BLE events; the prints are compiled out otherwise
 
 # Bluetooth event constants
 IRQ_CENTRAL_CONNECT = const(1)
@@ -18,103 +18,86 @@ IRQ_GET_SECRET = const(29)
 IRQ_SET_SECRET = const(30)
 
 # File for storing paired devices
-PAIRED_DEVICES_FILE = "paired_devices.json"
+PAIRED_DEVICES_FILE = "paired_devices.log"  # Same log as BluetoothKeyboard, so the example and main.py share bonds
 
 # IO capability configuration for security mode
 IO_CAPABILITY_DISPLAY_ONLY = const(0)
 
 
-def exists(path: str) -> bool:
-    """Check if a file exists."""
-    try:
-        os.stat(path)
-        return True
-    except OSError:
-        return False
+# Advertising data never changes, same bytes as build_adv_data(name="MicroKeyBoard", service_uuids=[0x1812])
+ADV_DATA = (
+    b'\x02\x01\x06'  # Flags: general discoverable, BR/EDR not supported
+    b'\x03\x03\x12\x18'  # Complete 16-bit service UUIDs: HID
+    b'\x0e\x09MicroKeyBoard'  # Complete local name
+)
 
 
-def build_adv_data(name: str = None, service_uuids: List[int] = None) -> bytes:
-    """
-    Build advertising data for BLE.
+def clear_paired_devices() -> None:
+    """Clear all paired device records."""
+    paired_devices.clear()
 
-    Args:
-        name: Device name to include in advertising data.
-        service_uuids: List of service UUIDs to include.
 
-    Returns:
-        Advertising data as bytes.
-    """
-    parts = []
-    # Flags indicating general discoverability and BLE-only mode
-    parts.append(b'\x02\x01\x06')
+def on_connect(data: tuple) -> None:
+    global bonded
+    conn_handle, addr_type, addr = data
+    if _DEBUG:
+        print("[Connect] Connected:", bytes(addr))
+    bonded = False  # Reset bonding status
 
-    if service_uuids:
-        for uuid in service_uuids:
-            uuid_bytes = struct.pack('<H', uuid)
-            svc_part = struct.pack('BB', 1 + len(uuid_bytes), 0x03) + uuid_bytes
-            parts.append(svc_part)
-            break
 
-    if name:
-        encoded_name = name.encode('utf-8')
-        name_header = struct.pack('BB', 1 + len(encoded_name), 0x09)
-        parts.append(name_header + encoded_name)
+def on_disconnect(data: tuple) -> None:
+    conn_handle, addr_type, addr = data
+    if _DEBUG:
+        print("[Disconnect] Disconnected:", bytes(addr))
 
-    return b''.join(parts)
+    # Stop advertising and restart after a delay, without blocking the IRQ
+    ble.gap_advertise(None)
+    adv_timer.init(mode=Timer.ONE_SHOT, period=1000, callback=lambda t: start_advertising())
 
 
-def save_paired_device(paired_device_keys: Dict) -> None:
-    """
-    Save paired device information to a file.
+def on_encryption_update(data: tuple) -> None:
+    global bonded
+    conn_handle, encrypted, authenticated, bonded, key_size = data
+    if _DEBUG:
+        print(f"Encryption state: encrypted={encrypted}, authenticated={authenticated}")
 
-    Args:
-        paired_device_keys: Dictionary containing paired device keys.
-    """
-    try:
-        paired_device_data = [
-            [sec_type, binascii.b2a_base64(key).decode(), binascii.b2a_base64(value).decode()]
-            for (sec_type, key), value in paired_device_keys.items()
-        ]
-        with open(PAIRED_DEVICES_FILE, 'w') as f:
-            json.dump(paired_device_data, f)
-        os.sync()
-        print("Paired devices saved:", paired_device_data)
-    except Exception as e:
-        print("Failed to save paired devices:", e)
-
-
-def load_paired_device() -> Dict:
-    """
-    Load paired device information from a file.
 
-    Returns:
-        Dictionary containing paired device keys.
-    """
-    if not exists(PAIRED_DEVICES_FILE):
-        return {}
-    try:
-        paired_device_keys = {}
-        with open(PAIRED_DEVICES_FILE, 'r') as f:
-            paired_device_data = json.load(f)
-        print("Loaded paired devices:", paired_device_data)
-        for sec_type, key, value in paired_device_data:
-            paired_device_keys[(sec_type, binascii.a2b_base64(key))] = binascii.a2b_base64(value)
-        return paired_device_keys
-    except Exception as e:
-        print("Failed to load paired devices:", e)
-        return {}
+def on_get_secret(data: tuple):
+    sec_type, index, key = data
+    if _DEBUG:
+        print(f"IRQ_GET_SECRET: type={sec_type}, index={index}")
+    if key is None:
+        return None
+    return paired_devices.get(sec_type, key)
 
 
-def clear_paired_devices() -> None:
-    """Clear all paired device records."""
-    try:
-        os.remove(PAIRED_DEVICES_FILE)
-        print("Cleared all paired device records.")
-    except OSError:
-        print("No paired device records to clear.")
+def on_set_secret(data: tuple) -> bool:
+    sec_type, key, value = data
+    if _DEBUG:
+        print(f"IRQ_SET_SECRET: type={sec_type}, key={bytes(key)}, value={value and bytes(value)}")
+    paired_devices.set(sec_type, key, value)  # Saved from the main loop
+    return value is None
+
+
+def on_mtu_exchanged(data: tuple) -> None:
+    conn_handle, mtu = data
+    if _DEBUG:
+        print(f"IRQ_MTU_EXCHANGED: mtu={mtu}")
+    ble.config(mtu=mtu)
+
+
+# Event handlers looked up by ble_irq
+IRQ_HANDLERS = {
+    IRQ_CENTRAL_CONNECT: on_connect,
+    IRQ_CENTRAL_DISCONNECT: on_disconnect,
+    IRQ_ENCRYPTION_UPDATE: on_encryption_update,
+    IRQ_GET_SECRET: on_get_secret,
+    IRQ_SET_SECRET: on_set_secret,
+    IRQ_MTU_EXCHANGED: on_mtu_exchanged,
+}
 
 
-def ble_irq(event: int, data: tuple) -> None:
+def ble_irq(event: int, data: tuple):
     """
     Handle BLE IRQ (interrupt request) events.
 
@@ -122,77 +105,18 @@ def ble_irq(event: int, data: tuple) -> None:
         event: Event type.
         data: Event-specific data.
     """
-    global bonded, paired_device_keys
-
-    if event == IRQ_CENTRAL_CONNECT:
-        conn_handle, addr_type, addr = data
-        print("[Connect] Connected:", bytes(addr))
-        bonded = False  # Reset bonding status
-
-    elif event == IRQ_CENTRAL_DISCONNECT:
-        conn_handle, addr_type, addr = data
-        print("[Disconnect] Disconnected:", bytes(addr))
-
-        # Stop advertising and restart after a delay
-        ble.gap_advertise(None)
-        time.sleep_ms(1000)
-        start_advertising()
-
-    elif event == IRQ_ENCRYPTION_UPDATE:
-        conn_handle, encrypted, authenticated, bonded, key_size = data
-        print(f"Encryption state: encrypted={encrypted}, authenticated={authenticated}")
-
-    elif event == IRQ_GET_SECRET:
-        sec_type, index, key = data
-        key = bytes(key) if key is not None else None
-        print(f"IRQ_GET_SECRET: type={sec_type}, index={index}")
-        if key is None:
-            return None
-        if paired_device_keys and (sec_type, key) in paired_device_keys:
-            return paired_device_keys[(sec_type, key)]
-        return None
-
-    elif event == IRQ_SET_SECRET:
-        sec_type, key, value = data
-        key = bytes(key) if key is not None else None
-        value = bytes(value) if value is not None else None
-        print(f"IRQ_SET_SECRET: type={sec_type}, key={key}, value={value}")
-        if paired_device_keys is None:
-            paired_device_keys = {}
-        if value is None:
-            paired_device_keys.pop((sec_type, key), None)
-            save_paired_device(paired_device_keys)
-            return True
-        else:
-            paired_device_keys[(sec_type, key)] = value
-            save_paired_device(paired_device_keys)
-        return False
-
-    elif event == IRQ_MTU_EXCHANGED:
-        conn_handle, mtu = data
-        print(f"IRQ_MTU_EXCHANGED: mtu={mtu}")
-        ble.config(mtu=mtu)
-
-    else:
+    handler = IRQ_HANDLERS.get(event)
+    if handler is not None:
+        return handler(data)
+    if _DEBUG:
         print(f"Unhandled event: {event}")
 
 
 def start_advertising() -> None:
-    """Start BLE advertising (peripheral mode)."""
-    ble.config(
-        io=IO_CAPABILITY_DISPLAY_ONLY,  # Set IO capability
-        bond=True,  # Enable bonding
-        le_secure=True  # Enable LE secure connections
-    )
-
-    # Build advertising data with device name and service UUIDs
-    adv_data = build_adv_data(
-        name="MicroKeyBoard",
-        service_uuids=[0x1812]  # HID service UUID
-    )
+    """Start BLE advertising (peripheral mode), the payload and security config are set up once at startup."""
     ble.gap_advertise(
         interval_us=100,
-        adv_data=adv_data,
+        adv_data=ADV_DATA,
         connectable=True,
         resp_data=None
     )
@@ -200,15 +124,18 @@ def start_advertising() -> None:
 
 if __name__ == "__main__":
     # Load paired device keys from file
-    paired_device_keys = load_paired_device()
+    paired_devices = PairedKeyStore(PAIRED_DEVICES_FILE)
 
     # Initialize BLE
     ble = bluetooth.BLE()
+    adv_timer = Timer(0)
     ble.active(True)
     ble.config(
         gap_name="MicroKeyBoard",
         mitm=True,  # Require man-in-the-middle protection
-        bond=True  # Enable bonding
+        bond=True,  # Enable bonding
+        io=IO_CAPABILITY_DISPLAY_ONLY,  # Set IO capability
+        le_secure=True  # Enable LE secure connections
     )
     ble.irq(ble_irq)
 
@@ -217,5 +144,12 @@ if __name__ == "__main__":
 
     # Print the device MAC address
     mac_address = ble.config('mac')[1]
-    print("Device MAC Address:", ":".join("{:02X}".format(x) for x in mac_address))
-
+    try: mac_str = mac_address.hex(':').upper()
+    except TypeError: mac_str = ":".join("{:02X}".format(x) for x in mac_address)  # Port without the separator argument
+    print("Device MAC Address:", mac_str)
+
+    # Save paired devices outside the IRQ, coalescing bursts of IRQ_SET_SECRET
+    while True:
+        paired_devices.flush()
+        paired_devices.sync()
+        time.sleep_ms(200)
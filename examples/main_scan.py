@@ -1,5 +1,10 @@
 import time
-from machine import Pin
+from machine import Pin, SPI
+
+# Bit position of each single-bit byte value
+_BIT_INDEX = bytearray(256)
+for _i in range(8):
+    _BIT_INDEX[1 << _i] = _i
 
 def main():
     CE_PIN = 13  # Clock Enable pin
@@ -8,11 +13,21 @@ def main():
     SPI_MISO = 12  # SPI Master In Slave Out pin
     SR_POWER_CONTROLL = 21 # shift register power
     WAKE_UP = 7
+    KEY_NUM = 72
 
     key_pl = Pin(PL_PIN, Pin.OUT, value=1)
-    key_ce = Pin(CE_PIN, Pin.OUT, value=1)
-    key_clk = Pin(SPI_CLOCK, Pin.OUT, value=0)
-    key_in = Pin(SPI_MISO, Pin.IN)
+    key_ce = Pin(CE_PIN, Pin.OUT, value=0)
+    # Clock the shift registers with the SPI peripheral, same settings as KeyBoard's "SPI" scan mode
+    spi = SPI(
+        1,
+        baudrate=1000000,
+        sck=Pin(SPI_CLOCK),
+        mosi=None,
+        miso=Pin(SPI_MISO),
+        polarity=1,
+        firstbit=SPI.LSB
+    )
+    buf = bytearray((KEY_NUM + 7) // 8)
     
     if SR_POWER_CONTROLL is not None:
         power_controll = Pin(SR_POWER_CONTROLL, Pin.OUT, value=1)
@@ -20,24 +35,19 @@ def main():
 
     time.sleep_ms(500)
     while True:
+        # Latch the key states, then shift all of them in at once
         key_pl.value(0)
-        time.sleep_ms(1)
         key_pl.value(1)
-        time.sleep_ms(1)
-        key_ce.value(0)
-        time.sleep_ms(1)
-        for i in range(72):
-            if not key_in.value():
-                print(i)
-            key_clk.value(1)
-            time.sleep_ms(1)
-            key_clk.value(0)
-            time.sleep_ms(1)
-        key_ce.value(1)
+        spi.readinto(buf)
+        for byte_index in range(len(buf)):
+            pressed = ~buf[byte_index] & 0xFF  # Pressed keys read low
+            while pressed:  # Usually zero, only bytes with pressed keys are walked
+                lowest = pressed & -pressed
+                print((byte_index << 3) + _BIT_INDEX[lowest])
+                pressed ^= lowest
+        time.sleep_ms(100)
     
     pass
 
 if __name__ == "__main__":
     main()
-
-
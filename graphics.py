@@ -1,3 +1,6 @@
+import micropython
+
+
 # From https://github.com/russhughes/st7789py_mpy/blob/master/examples/color_test.py
 def interpolate(value1, value2, position, total_range):
     """
@@ -13,3 +16,9 @@ def interpolate(value1, value2, position, total_range):
         float: Interpolated value.
     """
     return value1 + (value2 - value1) * position / total_range
+
+
+@micropython.viper
+def interpolate_int(value1: int, value2: int, position: int, total_range: int) -> int:
+    """Integer-only interpolate for 0-255 color channels, compiled with viper."""
+    return value1 + ((value2 - value1) * position) // total_range
@@ -1,13 +1,17 @@
+import os
 import time
 import json
+import array
 import machine
 import gc
 import usb
+import micropython
 import neopixel
 
 from machine import Pin, I2S, SPI, SoftSPI
+from micropython import const
 from typing import Optional, Callable, List, Dict, Tuple, Union
-from utils import DEBUG, debugging, debug_switch
+from utils import DEBUG, debugging, debug_switch, debug_log
 from usb.device.keyboard import KeyboardInterface, KeyCode, LEDCode
 
 from bluetoothkeyboard import BluetoothKeyboard
@@ -16,6 +20,21 @@ from keys import PhysicalKey, VirtualKey
 from utils import partial, exists, makedirs
 from tca8418 import TCA8418
 
+_DEBUG_SCAN = const(0)  # Set to 1 to log every physical key change with utils.debug_log, compiled out otherwise
+
+# KeyCode values by attribute name, filled as the layer mappings resolve them
+_KC_CACHE: Dict[str, Optional[int]] = {}
+
+
+def resolve_keycode(key_code_name: Optional[str]) -> Optional[int]:
+    """Returns the KeyCode value named key_code_name, or None if there is no such key, each name is looked up once."""
+    if key_code_name is None:
+        return None
+    keycode = _KC_CACHE.get(key_code_name, -1)
+    if keycode == -1:
+        keycode = _KC_CACHE[key_code_name] = getattr(KeyCode, key_code_name, None)
+    return keycode
+
 
 def fn_layer_pressed_function(
     virtual_key_board: "VirtualKeyBoard",
@@ -25,7 +44,7 @@ def fn_layer_pressed_function(
     original_func: Optional[Callable] = None,
     layer_id: int = 1,
 ):
-    if virtual_key_board.layer == int(layer_id):
+    if virtual_key_board.layer == layer_id:
         if layer_codes is not None:
             virtual_key.keycode = layer_codes[1]
         if pressed_function is not None:
@@ -44,13 +63,118 @@ def fn_layer_released_function(
 ):
     if layer_codes is not None:
         virtual_key.keycode = layer_codes[0]
-    if virtual_key_board.layer == int(layer_id):
+    if virtual_key_board.layer == layer_id:
         if released_function is not None:
             released_function()
     elif original_func is not None:
         original_func()
 
 
+# Bit position of each single-bit byte value, used to walk the set bits of a byte
+_BIT_INDEX = bytearray(256)
+for _i in range(8):
+    _BIT_INDEX[1 << _i] = _i
+
+
+# ESP32-S3 GPIO registers for pins 0-31, the OUT1/IN1 registers cover pins 32-48
+_GPIO_OUT_W1TS_REG = 0x60004008
+_GPIO_OUT_W1TC_REG = 0x6000400C
+_GPIO_OUT1_W1TS_REG = 0x60004014
+_GPIO_OUT1_W1TC_REG = 0x60004018
+_GPIO_IN_REG = 0x6000403C
+_GPIO_IN1_REG = 0x60004040
+
+
+def gpio_scan_regs(clock_pin: int, read_pin: int) -> array.array:
+    """Returns [clock set register, clock clear register, clock bit, input register, data bit] for _scan_gpio_regs, the addresses are the ESP32-S3's."""
+    return array.array('I', [
+        _GPIO_OUT1_W1TS_REG if clock_pin >= 32 else _GPIO_OUT_W1TS_REG,
+        _GPIO_OUT1_W1TC_REG if clock_pin >= 32 else _GPIO_OUT_W1TC_REG,
+        clock_pin & 31,
+        _GPIO_IN1_REG if read_pin >= 32 else _GPIO_IN_REG,
+        read_pin & 31,
+    ])
+
+
+@micropython.viper
+def _scan_gpio_regs(buf: ptr8, nkeys: int, regs: ptr32):
+    """Same as _scan_gpio without delays, but reads and clocks the pins through the GPIO registers from gpio_scan_regs.
+    The clock pulse width and data setup time have not been measured yet, so this is only used when gpio_registers is enabled."""
+    out_set = ptr32(regs[0])
+    out_clear = ptr32(regs[1])
+    clk_mask = 1 << regs[2]
+    gpio_in = ptr32(regs[3])
+    din_bit = regs[4]
+    for j in range((nkeys + 7) >> 3):
+        buf[j] = 0
+    for i in range(nkeys):
+        buf[i >> 3] = buf[i >> 3] | (((gpio_in[0] >> din_bit) & 1) << (i & 7))
+        out_set[0] = clk_mask
+        out_set[0] = clk_mask  # Written twice to stretch the clock high time, unverified against the 74HC165 minimum pulse width
+        out_clear[0] = clk_mask
+
+
+@micropython.viper
+def _scan_gpio(buf: ptr8, nkeys: int, pins, delay_us: int):
+    """Shifts nkeys bits from the shift register chain into buf by toggling the clock, bit i of the chain lands in buf[i >> 3] bit (i & 7).
+    pins is (clock pin value method, data pin value method)."""
+    clk_set = pins[0]
+    din_val = pins[1]
+    for j in range((nkeys + 7) >> 3):
+        buf[j] = 0
+    sleep_us = time.sleep_us
+    for i in range(nkeys):
+        buf[i >> 3] = buf[i >> 3] | (int(din_val()) << (i & 7))
+        clk_set(1)
+        if delay_us > 0:
+            sleep_us(delay_us)
+        clk_set(0)
+        if delay_us > 0:
+            sleep_us(delay_us)
+
+
+@micropython.viper
+def _first_diff(a: ptr32, b: ptr32, nwords: int) -> int:
+    """Returns the index of the first of the first nwords 32-bit words where a and b differ, -1 if they are equal."""
+    for i in range(nwords):
+        if a[i] != b[i]:
+            return i
+    return -1
+
+
+@micropython.viper
+def _word_differs(a: ptr32, b: ptr32, i: int) -> int:
+    """Returns 1 if the i-th 32-bit words of a and b differ."""
+    return int(a[i] != b[i])
+
+
+def layer_pressed_function(virtual_key_board: "VirtualKeyBoard", virtual_key: "VirtualKey"):
+    """Looks up the keycode and pressed function of the active layer, one dict lookup however many layers there are."""
+    keycode, pressed_function, _ = virtual_key.layer_actions.get(virtual_key_board.layer, virtual_key.base_action)
+    virtual_key.keycode = keycode
+    if pressed_function is not None:
+        pressed_function()
+
+
+def layer_released_function(virtual_key_board: "VirtualKeyBoard", virtual_key: "VirtualKey"):
+    virtual_key.keycode = virtual_key.base_action[0]
+    _, _, released_function = virtual_key.layer_actions.get(virtual_key_board.layer, virtual_key.base_action)
+    if released_function is not None:
+        released_function()
+
+
+def music_pressed_function(music_key_board: "MusicKeyBoard", virtual_key: "VirtualKey"):
+    """Starts the note of a music key, virtual_key.note and playing_wav_id are set by MusicKeyBoard.build_virtual_keys."""
+    if music_key_board.music_enabled:
+        virtual_key.playing_wav_id = music_key_board.audio_manager.play_note(virtual_key.note)
+
+
+def music_released_function(music_key_board: "MusicKeyBoard", virtual_key: "VirtualKey"):
+    if virtual_key.playing_wav_id >= 0:
+        music_key_board.audio_manager.stop_note(wav_id=virtual_key.playing_wav_id, delay=500)
+        virtual_key.playing_wav_id = -1
+
+
 class LEDManager:
     def __init__(
         self,
@@ -70,10 +194,13 @@ class LEDManager:
         self.led_power.value(self.enabled)
 
         self.pixels = neopixel.NeoPixel(Pin(self.led_data_pin, Pin.OUT), self.led_pixels)
+        self._buf = self.pixels.buf  # Pixel bytes written in place by set_pixel and fast_fill
+        self._bpp = self.pixels.bpp
+        self._order = self.pixels.ORDER  # Byte offset of each channel within a pixel, GRB on WS2812
         # for i in range(self.led_pixels):
         #     self.pixels[i] = (self.onstart_light_level, self.onstart_light_level, self.onstart_light_level)
-        self.pixels.fill((self.onstart_light_level, self.onstart_light_level, self.onstart_light_level))
-        self.pixels.write()
+        self.fast_fill((self.onstart_light_level, self.onstart_light_level, self.onstart_light_level))
+        self.force_write()
 
     def disable(self):
         self.enabled = False
@@ -82,27 +209,70 @@ class LEDManager:
     def enable(self):
         self.enabled = True
         self.led_power.value(1)
-        self.write_pixels()
+        self.force_write()  # The strip lost its state while powered off
     
     def switch(self):
         self.enabled = not self.enabled
         self.led_power.value(self.enabled)
         if self.enabled:
-            self.write_pixels()
+            self.force_write()
 
     def clear(self):
-        self.pixels.fill((0, 0, 0))
-        self.pixels.write()
+        self.fast_fill((0, 0, 0))
+        self.write_pixels()
 
     def set_pixel(self, i: Union[int, str], color: Tuple[int], write: bool = False):
         if isinstance(i, str):
             i = self.ledmap[i]
-        self.pixels[i] = tuple(min(l, self.max_light_level) for l in color)
+        m = self.max_light_level
+        r, g, b = color
+        if r > m: r = m
+        if g > m: g = m
+        if b > m: b = m
+        # Write straight into the pixel buffer instead of going through a tuple per call
+        buf = self._buf
+        order = self._order
+        off = i * self._bpp
+        r_off, g_off, b_off = off + order[0], off + order[1], off + order[2]
+        if buf[r_off] != r or buf[g_off] != g or buf[b_off] != b:
+            buf[r_off] = r
+            buf[g_off] = g
+            buf[b_off] = b
+            self._dirty = True
+        if write:
+            self.write_pixels()
+
+    def fast_fill(self, color: Tuple[int]):
+        """Sets every pixel to color, limited to max_light_level, with one slice assignment into the pixel buffer."""
+        m = self.max_light_level
+        r, g, b = color
+        if r > m: r = m
+        if g > m: g = m
+        if b > m: b = m
+        order = self._order
+        pixel = bytearray(self._bpp)
+        pixel[order[0]] = r
+        pixel[order[1]] = g
+        pixel[order[2]] = b
+        self._buf[:] = pixel * self.led_pixels
+        self._dirty = True
+
+    def fill_clamped(self, color: Tuple[int], write: bool = False):
+        """Sets every pixel to color, limited to max_light_level."""
+        self.fast_fill(color)
         if write:
-            self.pixels.write()
+            self.write_pixels()
 
     def write_pixels(self):
+        """Writes the pixels to the strip, skipped while the LEDs are powered off or nothing changed since the last write."""
+        if not (self.enabled and self._dirty):
+            return
+        self.force_write()
+
+    def force_write(self):
+        """Always transmits the pixel buffer."""
         self.pixels.write()
+        self._dirty = False
 
 
 class PhysicalKeyBoard:
@@ -120,20 +290,23 @@ class PhysicalKeyBoard:
         keymap_path: Optional[str] = None,  # "/config/physical_keymap.json",
         max_light_level: Optional[int] = None,
         scan_mode: Optional[int] = None,
+        gpio_registers: Optional[bool] = None,  # GPIO scan mode only, clock the chain through the ESP32-S3 GPIO registers
     ):
-        self.key_config = json.load(open(key_config_path))
-
-        ktype = ktype or self.key_config.get("ktype", None)
-        clock_pin = pl_pin or self.key_config.get("clock_pin", None)
-        pl_pin = pl_pin or self.key_config.get("pl_pin", None)
-        ce_pin = ce_pin or self.key_config.get("ce_pin", None)
-        read_pin = read_pin or self.key_config.get("read_pin", None)
-        power_pin = power_pin or self.key_config.get("power_pin", None)
-        wakeup_pin = wakeup_pin or self.key_config.get("wakeup_pin", None)
-        max_keys = max_keys or self.key_config.get("max_keys", None)
-        keymap_path = keymap_path or self.key_config.get("keymap_path", None)
-        max_light_level = max_light_level or self.key_config.get("max_light_level", None)
-        self.scan_mode = scan_mode or self.key_config.get("scan_mode", None)
+        with open(key_config_path) as f:
+            key_config = json.load(f)
+
+        ktype = ktype or key_config.get("ktype", None)
+        clock_pin = pl_pin or key_config.get("clock_pin", None)
+        pl_pin = pl_pin or key_config.get("pl_pin", None)
+        ce_pin = ce_pin or key_config.get("ce_pin", None)
+        read_pin = read_pin or key_config.get("read_pin", None)
+        power_pin = power_pin or key_config.get("power_pin", None)
+        wakeup_pin = wakeup_pin or key_config.get("wakeup_pin", None)
+        max_keys = max_keys or key_config.get("max_keys", None)
+        keymap_path = keymap_path or key_config.get("keymap_path", None)
+        max_light_level = max_light_level or key_config.get("max_light_level", None)
+        self.scan_mode = scan_mode or key_config.get("scan_mode", None)
+        gpio_registers = gpio_registers or key_config.get("gpio_registers", False)
     
         self.key_pl = Pin(pl_pin, Pin.OUT, value=1)
         self.key_ce = Pin(ce_pin, Pin.OUT, value=0)
@@ -142,9 +315,10 @@ class PhysicalKeyBoard:
         if self.scan_mode == "SPI":
             self.key_clk = Pin(clock_pin)
             self.key_in = Pin(read_pin)
+            # Idle-high clock sampled on the falling edge (polarity=1, phase=0), the 74HC165 shifts on the rising edge
             self.spi = SPI(
                 1,
-                baudrate=4000000,
+                baudrate=8000000,
                 sck=self.key_clk,
                 mosi=None,
                 miso=self.key_in,
@@ -155,7 +329,7 @@ class PhysicalKeyBoard:
             self.key_clk = Pin(clock_pin)
             self.key_in = Pin(read_pin)
             self.spi = SoftSPI(
-                baudrate=100000,
+                baudrate=1000000,  # SoftSPI tops out well below this, it just clocks as fast as it can
                 sck=self.key_clk,
                 mosi=Pin(0),
                 miso=self.key_in,
@@ -168,69 +342,76 @@ class PhysicalKeyBoard:
             self.spi = None
         else:
             raise NotImplementedError(f"scan mode not implemented: {self.scan_mode}")
+        # Bound pin methods, so scan_keys does not look up .value on every call
+        self._kin_val = self.key_in.value
+        self._kclk_set = self.key_clk.value
+        self._kpl_set = self.key_pl.value
+        self._gpio_pins = (self._kclk_set, self._kin_val)
+        # Direct register access for the bit-banged chain, opt-in until its timing has been checked, None uses the Pin methods
+        self._gpio_regs = gpio_scan_regs(clock_pin, read_pin) if self.scan_mode == "GPIO" and gpio_registers else None
+        self._spi_readinto = self.spi.readinto if self.spi is not None else None
 
         self.max_keys = max_keys
         self.physical_keys = [None for _ in range(max_keys)]
-        keymap_json = json.load(open(keymap_path))
-        if "keymap" in keymap_json:
-            self.keymap_dict = keymap_json["keymap"]
-        else:
-            self.keymap_dict = keymap_json
-        self.used_key_num = len(self.keymap_dict)
+        with open(keymap_path) as f:
+            keymap_json = json.load(f)
+        keymap = keymap_json["keymap"] if "keymap" in keymap_json else keymap_json  # Only needed to build physical_keys
+        self.used_key_num = len(keymap)
         assert self.used_key_num <= self.max_keys, "More keys are used than the maximum allowed!"
-        for key_name, key_id in self.keymap_dict.items():
+        for key_name, key_id in keymap.items():
             self.physical_keys[key_id] = PhysicalKey(key_id=key_id, key_name=key_name, max_light_level=max_light_level)
         
-        self.led_manager = LEDManager(self.key_config, ledmap=keymap_json.get("ledmap", {}))
+        ledmap = keymap_json.get("ledmap", {})
+        del keymap_json, keymap
+        gc.collect()  # Free the parsed config before the NeoPixel buffer is allocated
+        self.led_manager = LEDManager(key_config, ledmap=ledmap)
 
         # Calculate the number of bytes needed to store max_keys bits
         self.bytes_needed = (self.max_keys + 7) // 8
 
-        # Double buffer for key states: previous_state and current_state
-        # Each key state is stored as a bit (0 or 1)
-        self._buffer_a = bytearray(self.bytes_needed)
-        self._buffer_b = bytearray(self.bytes_needed)
-        for byte_index in range(self.bytes_needed):
-            self._buffer_a[byte_index] = 0xff
-            self._buffer_b[byte_index] = 0xff
+        # Physical keys grouped by state byte, None for unused and padding bits
+        self._keys_by_byte = [
+            [self.physical_keys[b * 8 + i] if b * 8 + i < self.max_keys else None for i in range(8)]
+            for b in range(self.bytes_needed)
+        ]
 
-        # Pointers to the current and previous state buffers
-        self._current_buffer = self._buffer_a
-        self._previous_buffer = self._buffer_b # Initially, both are zero, representing all keys released
+        # Double buffer for key states: previous_state and current_state
+        # Each key state is stored as a bit (0 or 1), padded to whole 32-bit words for _first_diff
+        self._state_words = (self.bytes_needed + 3) // 4
+        self._buffer_a = bytearray(b'\xff' * (self._state_words * 4))
+        self._buffer_b = bytearray(b'\xff' * (self._state_words * 4))
+
+        # Bits of the keys in the keymap, changes on unused inputs and padding are masked out before the per-bit loop
+        populated_mask = bytearray(self._state_words * 4)
+        for key_id in range(self.max_keys):
+            if self.physical_keys[key_id] is not None:
+                populated_mask[key_id >> 3] |= 1 << (key_id & 7)
+        self._populated_mask = bytes(populated_mask)
+
+        # The buffer at _cur_idx is the current state, the other one the previous state
+        # Initially, both are all ones, representing all keys released. The views cover only the bytes that are read
+        self._bufs = (self._buffer_a, self._buffer_b)
+        self._views = (memoryview(self._buffer_a)[:self.bytes_needed], memoryview(self._buffer_b)[:self.bytes_needed])
+        self._cur_idx = 0
         
-    def scan_keys(self, interval_us=1, scan_mode: Optional[str] = None) -> None:
-        scan_mode = scan_mode or self.scan_mode
-        if scan_mode in ("SPI", "SoftSPI"):
+    def scan_keys(self, interval_us=0, scan_mode: Optional[str] = None) -> None:
+        kpl_set = self._kpl_set
+        if scan_mode is None and self._spi_readinto is not None or scan_mode in ("SPI", "SoftSPI"):
             # Load key state
-            self.key_pl.value(0)
-            self.key_pl.value(1)
-            self.spi.readinto(self._current_buffer)
+            kpl_set(0)
+            kpl_set(1)
+            self._spi_readinto(self._views[self._cur_idx])
         else:
-            self.key_pl.value(0)
-            time.sleep_us(interval_us)
-            self.key_pl.value(1)
-            time.sleep_us(interval_us)
-            for byte_index in range(self.bytes_needed):
-                self._current_buffer[byte_index] = 0
+            # GPIO writes take longer than the 74HC165 setup time, only sleep when a delay is asked for
+            kpl_set(0)
+            if interval_us > 0: time.sleep_us(interval_us)
+            kpl_set(1)
+            if interval_us > 0: time.sleep_us(interval_us)
             # read key states
-            # self.key_ce.value(0)
-            # time.sleep_us(interval_us)
-            for i in range(self.max_keys):
-                # key_states[i] = not self.key_in.value()
-
-                # Determine byte and bit index
-                byte_index = i // 8
-                bit_index = i % 8
-
-                # Read the pin value
-                state = int(self.key_in.value())
-
-                self._current_buffer[byte_index] |= (state << bit_index)
-
-                self.key_clk.value(1)
-                time.sleep_us(interval_us)
-                self.key_clk.value(0)
-                time.sleep_us(interval_us)
+            if self._gpio_regs is not None and interval_us <= 0:
+                _scan_gpio_regs(self._bufs[self._cur_idx], self.max_keys, self._gpio_regs)
+            else:
+                _scan_gpio(self._bufs[self._cur_idx], self.max_keys, self._gpio_pins, interval_us)
             # self.key_ce.value(1)
 
     def sleep(self):
@@ -253,72 +434,69 @@ class PhysicalKeyBoard:
         if led_enabled:
             self.led_manager.enable()
 
-    def scan(self, interval_us=1, activate: bool = True) -> bool:  # TODO: filter
+    def scan(self, interval_us=0, activate: bool = True) -> bool:  # TODO: filter
         # activate is always True
-        self.scan_keys(interval_us=interval_us)
+        cur_idx = self._cur_idx
+        spi_readinto = self._spi_readinto
+        if spi_readinto is not None:  # Same as scan_keys() in SPI mode, inlined to save a call per tick
+            kpl_set = self._kpl_set
+            kpl_set(0)
+            kpl_set(1)
+            spi_readinto(self._views[cur_idx])
+        else:
+            self.scan_keys(interval_us=interval_us)
+        current_buffer = self._bufs[cur_idx]
+        previous_buffer = self._bufs[cur_idx ^ 1]
+        first_word = _first_diff(current_buffer, previous_buffer, self._state_words)
+        if first_word < 0:
+            return False  # Nothing changed, the buffers are equal so there is no need to swap them
+        keys_by_byte = self._keys_by_byte
+        populated_mask = self._populated_mask
         scan_change = False
-        for byte_index in range(self.bytes_needed):
-            current_byte = self._current_buffer[byte_index]
-            previous_byte = self._previous_buffer[byte_index]
-
-            # Find changed bits using XOR: bit is 1 if different, 0 if same
-            changed_bits = current_byte ^ previous_byte
-
-            # If there are any changes in this byte
-            if changed_bits:
+        for word_index in range(first_word, self._state_words):
+            # Skip whole 4-byte words that did not change, padding bytes are 0xff in both buffers and never differ
+            if word_index != first_word and not _word_differs(current_buffer, previous_buffer, word_index):
+                continue
+            for byte_index in range(word_index * 4, word_index * 4 + 4):
+                current_byte = current_buffer[byte_index]
+
+                # Find changed bits using XOR: bit is 1 if different, 0 if same
+                changed_bits = (current_byte ^ previous_buffer[byte_index]) & populated_mask[byte_index]
+                if not changed_bits:
+                    continue
                 scan_change = True
-                # Iterate through each bit in the byte (0 to 7)
-                for bit_index in range(8):
-                    # Calculate the global key ID
-                    key_id = byte_index * 8 + bit_index
-
-                    # Stop if we exceed the actual number of keys
-                    if key_id >= self.max_keys:
-                        break # Exit inner loop (bits in byte)
-
-                    # Check if this specific bit (key) changed
-                    if (changed_bits >> bit_index) & 1:
-                        # Get the current state of the key (0 or 1)
-                        current_state = (current_byte >> bit_index) & 1
-
-                        physical_key = self.physical_keys[key_id]
-                        if physical_key is None:
-                            continue
-
-                        # If state changed and current state is 0 (1 -> 0): Key Pressed
-                        if current_state == 0:
-                            # This check should technically not be needed if logic is perfect,
-                            # but good defensive programming.
-                            # if not physical_key.pressed:
-                            physical_key.pressed = True
-                            if debugging():
-                                print(f"physical({physical_key.key_id}, {physical_key.key_name}) is pressed at {time.ticks_ms()}.")
-                            if physical_key.bind_virtual is not None:
-                                physical_key.bind_virtual.press()
-                            else:
-                                if debugging():
-                                    print(f"physical({physical_key.key_id}, {physical_key.key_name}) not bind for press")
-
-                        # If state changed and current state is 1 (0 -> 1): Key Released
-                        else: # current_state must be 1
-                            # This check should technically not be needed
-                            # if physical_key.pressed:
-                            physical_key.pressed = False
-                            if debugging():
-                                print(f"physical({physical_key.key_id}, {physical_key.key_name}) is released at {time.ticks_ms()}.")
-                            if physical_key.bind_virtual is not None:
-                                physical_key.bind_virtual.release()
-                            else:
-                                if debugging():
-                                    print(f"physical({physical_key.key_id}, {physical_key.key_name}) not bind for release")
-
-        self._previous_buffer, self._current_buffer = self._current_buffer, self._previous_buffer
+                byte_keys = keys_by_byte[byte_index]
+
+                # Visit only the changed bits, lowest first
+                while changed_bits:
+                    lowest = changed_bits & -changed_bits
+                    changed_bits ^= lowest
+                    physical_key = byte_keys[_BIT_INDEX[lowest]]
+
+                    # State changed and current state is 0 (1 -> 0): Key Pressed
+                    if not current_byte & lowest:
+                        physical_key.pressed = True
+                        if _DEBUG_SCAN:
+                            debug_log(f"physical({physical_key.key_id}, {physical_key.key_name}) is pressed at {time.ticks_ms()}{'' if physical_key.bind_virtual is not None else ', not bind'}.")
+                        if physical_key.bind_virtual is not None:
+                            physical_key.bind_virtual.press()
+
+                    # State changed and current state is 1 (0 -> 1): Key Released
+                    else:
+                        physical_key.pressed = False
+                        if _DEBUG_SCAN:
+                            debug_log(f"physical({physical_key.key_id}, {physical_key.key_name}) is released at {time.ticks_ms()}{'' if physical_key.bind_virtual is not None else ', not bind'}.")
+                        if physical_key.bind_virtual is not None:
+                            physical_key.bind_virtual.release()
+
+        self._cur_idx = cur_idx ^ 1
         return scan_change
 
     def is_pressed(self) -> bool:
-        self.scan_keys(scan_mode="GPIO")
+        self.scan_keys()  # Same reader as scan(), the SPI peripheral clocks the chain in one transfer
+        current_buffer = self._bufs[self._cur_idx]
         for byte_index in range(self.bytes_needed):
-            current_byte = self._current_buffer[byte_index]
+            current_byte = current_buffer[byte_index]
             if current_byte < 0xff:
                 # key_id = byte_index * 8 + bit_index
                 print(f"Is pressed: {byte_index}, {current_byte}")
@@ -331,17 +509,18 @@ class TCA8418PhysicalKeyBoard(PhysicalKeyBoard):
         self,
         key_config_path: str = "/config/physical_keyboard.json",
     ):
-        self.key_config = json.load(open(key_config_path))
+        with open(key_config_path) as f:
+            key_config = json.load(f)
 
-        ktype = self.key_config.get("ktype", None)
-        sda_pin = self.key_config.get("sda_pin", None)
-        scl_pin = self.key_config.get("scl_pin", None)
-        wakeup_pin = self.key_config.get("wakeup_pin", None)
+        ktype = key_config.get("ktype", None)
+        sda_pin = key_config.get("sda_pin", None)
+        scl_pin = key_config.get("scl_pin", None)
+        wakeup_pin = key_config.get("wakeup_pin", None)
         
-        max_keys = self.key_config.get("max_keys", None)
-        keymap_path = self.key_config.get("keymap_path", None)
-        max_light_level = self.key_config.get("max_light_level", None)
-        self.scan_mode = self.key_config.get("scan_mode", None)
+        max_keys = key_config.get("max_keys", None)
+        keymap_path = key_config.get("keymap_path", None)
+        max_light_level = key_config.get("max_light_level", None)
+        self.scan_mode = key_config.get("scan_mode", None)
 
         self.tca_addr = 0x34
     
@@ -397,59 +576,62 @@ class TCA8418PhysicalKeyBoard(PhysicalKeyBoard):
         # TODO: reuse below code:
         self.max_keys = max_keys
         self.physical_keys = [None for _ in range(max_keys)]
-        keymap_json = json.load(open(keymap_path))
-        if "keymap" in keymap_json:
-            self.keymap_dict = keymap_json["keymap"]
-        else:
-            self.keymap_dict = keymap_json
-        self.used_key_num = len(self.keymap_dict)
+        with open(keymap_path) as f:
+            keymap_json = json.load(f)
+        keymap = keymap_json["keymap"] if "keymap" in keymap_json else keymap_json  # Only needed to build physical_keys
+        self.used_key_num = len(keymap)
         assert self.used_key_num <= self.max_keys, "More keys are used than the maximum allowed!"
-        for key_name, key_id in self.keymap_dict.items():
+        for key_name, key_id in keymap.items():
             self.physical_keys[key_id] = PhysicalKey(key_id=key_id, key_name=key_name, max_light_level=max_light_level)
         
-        self.led_manager = LEDManager(self.key_config, ledmap=keymap_json.get("ledmap", {}))
+        ledmap = keymap_json.get("ledmap", {})
+        del keymap_json, keymap
+        gc.collect()  # Free the parsed config before the NeoPixel buffer is allocated
+        self.led_manager = LEDManager(key_config, ledmap=ledmap)
 
     def tca_interrupt_handler(self, pin):
         self.event_pending = True
 
-    def scan(self, interval_us: int = 1, activate: bool = False) -> bool:  # TODO: activate scan
+    def scan(self, interval_us: int = 0, activate: bool = False) -> bool:  # TODO: activate scan
         if not (self.event_pending or activate):
             return False
-        time.sleep_us(interval_us)
+        if interval_us > 0: time.sleep_us(interval_us)
         self.event_pending = False
         tca = self.tca
         event_flag = False
-        while tca.get_events_count() > 0:
-            event = tca.read_next_event()
-            keycode = event & 0x7F
-            is_press = bool(event & 0x80)
-
-            if 1 <= keycode <= 80: # Keypad Array
-                event_flag = True
-                physical_key = self.physical_keys[keycode]
-                physical_key.pressed = is_press
-
-                if is_press:
-                    if debugging():
-                        print(f"physical({physical_key.key_id}, {physical_key.key_name}) is pressed at {time.ticks_ms()}.")
-                    if physical_key.bind_virtual is not None:
-                        physical_key.bind_virtual.press()
+        n = tca.get_events_count()
+        if n == 0:
+            return False
+        while n:  # Also drains events that arrive while a batch is handled, before the interrupt is cleared
+            events = tca.read_events_batch(min(n, 10))  # The FIFO holds at most 10 events
+            if not events:
+                self.event_pending = True  # I2C error, the interrupt stays set and the next scan retries
+                return event_flag
+            for event in events:
+                keycode = event & 0x7F
+                is_press = bool(event & 0x80)
+
+                if 1 <= keycode <= 80: # Keypad Array
+                    event_flag = True
+                    physical_key = self.physical_keys[keycode]
+                    physical_key.pressed = is_press
+
+                    if _DEBUG_SCAN:
+                        debug_log(f"physical({physical_key.key_id}, {physical_key.key_name}) is {'pressed' if is_press else 'released'} at {time.ticks_ms()}{'' if physical_key.bind_virtual is not None else ', not bind'}.")
+                    if is_press:
+                        if physical_key.bind_virtual is not None:
+                            physical_key.bind_virtual.press()
                     else:
-                        if debugging():
-                            print(f"physical({physical_key.key_id}, {physical_key.key_name}) not bind for press")
+                        if physical_key.bind_virtual is not None:
+                            physical_key.bind_virtual.release()
+                elif 97 <= keycode <= 104: # Row GPI Events
+                    pass
+                elif 105 <= (keycode - 1) <= 114: # Column GPI Events
+                    pass
                 else:
-                    if physical_key.bind_virtual is not None:
-                        physical_key.bind_virtual.release()
-                    else:
-                        if debugging():
-                            print(f"physical({physical_key.key_id}, {physical_key.key_name}) not bind for release")
-            elif 97 <= keycode <= 104: # Row GPI Events
-                pass
-            elif 105 <= (keycode - 1) <= 114: # Column GPI Events
-                pass
-            else:
-                raise NotImplementedError(f"Get tca8418 keycode: {keycode}")
-            tca.clear_key_int()
+                    raise NotImplementedError(f"Get tca8418 keycode: {keycode}")
+            n = tca.get_events_count()
+        tca.clear_key_int()
         return event_flag
 
     def is_pressed(self) -> bool:
@@ -483,7 +665,10 @@ class VirtualKeyBoard:
     ):
         # assert key_num >= self.phsical_key_board.used_key_num, "virt key num < phys key num."
         if exists(mapping_path):
-            self.virtual_key_mappings = json.load(open(mapping_path))
+            with open(mapping_path) as f:
+                self.virtual_key_mappings = json.load(f)
+            # JSON object keys are strings, layer ids are compared as ints everywhere else
+            self.virtual_key_mappings["layers"] = {int(k): v for k, v in self.virtual_key_mappings["layers"].items()}
             self.virtual_key_name = self.virtual_key_mappings.get("name", "MicroKeyBoard")
         else:
             self.virtual_key_mappings = None
@@ -509,9 +694,13 @@ class VirtualKeyBoard:
         self.ble_interface = None
         self.set_connection_mode(connection_mode)
 
-        self.pressed_keys: List[VirtualKey] = []
-        self.keystates = []
-        self.prev_keystates = []
+        self.down_keys: List[VirtualKey] = []  # Pressed keys that may carry a keycode, newest first
+        self._pressed_len = 0
+        # Keycodes of the report being built and of the last one sent, signed because modifiers are negative
+        # The first _pressed_len / _prev_len entries are valid, the rest stay zero
+        self.keystates = array.array('h', [0] * 6)
+        self.prev_keystates = array.array('h', [0] * 6)
+        self._prev_len = 0
 
         self.virtual_keys: List[VirtualKey] = None
         self.build_virtual_keys()
@@ -556,10 +745,10 @@ class VirtualKeyBoard:
             if physical_key is not None:
                 key_code_name = physical_key.key_name
                 if self.virtual_key_mappings is not None:
-                    key_code_name = self.virtual_key_mappings["layers"]["0"].get(physical_key.key_name, None) or key_code_name
+                    key_code_name = self.virtual_key_mappings["layers"][0].get(physical_key.key_name, None) or key_code_name
                 virtual_key = VirtualKey(
                     key_name=key_code_name,
-                    keycode=getattr(KeyCode, key_code_name, None),
+                    keycode=resolve_keycode(key_code_name),
                     physical_key=physical_key,
                     pressed_function=None,
                     released_function=None
@@ -567,19 +756,31 @@ class VirtualKeyBoard:
                 virtual_keys.append(virtual_key)
         self.virtual_keys = virtual_keys
         self.build_fn_layer(virtual_keys)
+        self.index_keycode_keys(virtual_keys)
+
+    def index_keycode_keys(self, virtual_keys: List[VirtualKey]):
+        """Hooks the keys that have a keycode on at least one layer into down_keys, the only list scan() looks at."""
+        layers = self.virtual_key_mappings["layers"].values() if self.virtual_key_mappings is not None else ()
+        for virtual_key in virtual_keys:
+            key_name = virtual_key.bind_physical.key_name
+            if virtual_key.keycode is not None or any(resolve_keycode(layer.get(key_name)) is not None for layer in layers):
+                virtual_key.down_keys = self.down_keys  # Track it in press order from now on
 
     def build_fn_layer(self, virtual_keys: List[VirtualKey]):
-        for layer_id in self.virtual_key_mappings["layers"]:  # TODO: check conflict
-            for virtual_key in virtual_keys:
-                physical_key = virtual_key.bind_physical
-                layer_i_code_name = self.virtual_key_mappings["layers"][layer_id].get(physical_key.key_name, None)
-                layer_codes = (virtual_key.keycode, getattr(KeyCode, layer_i_code_name, None) if layer_i_code_name is not None else None)
-                if self.virtual_key_mappings is not None and physical_key.key_name in self.virtual_key_mappings["layers"][layer_id]:
-                    virtual_key.pressed_function = partial(fn_layer_pressed_function, self, virtual_key, layer_codes, virtual_key.pressed_function, original_func=virtual_key.pressed_function, layer_id=int(layer_id))
-                    virtual_key.released_function = partial(fn_layer_released_function, self, virtual_key, layer_codes, virtual_key.released_function, original_func=virtual_key.released_function, layer_id=int(layer_id))
+        layers = self.virtual_key_mappings["layers"]
+        for virtual_key in virtual_keys:
+            key_name = virtual_key.bind_physical.key_name
+            # Layers without an entry fall back to the base keycode and functions
+            virtual_key.base_action = (virtual_key.keycode, virtual_key.pressed_function, virtual_key.released_function)
+            for layer_id, layer in layers.items():  # TODO: check conflict
+                if key_name in layer:
+                    virtual_key.layer_actions[layer_id] = (resolve_keycode(layer[key_name]), virtual_key.pressed_function, virtual_key.released_function)
+            virtual_key.pressed_function = partial(layer_pressed_function, self, virtual_key)
+            virtual_key.released_function = partial(layer_released_function, self, virtual_key)
 
         for virtual_key in virtual_keys:
             physical_key = virtual_key.bind_physical
+            keycode, _, released_function = virtual_key.base_action
             if physical_key.key_name == "FN":  # TODO: create ".py" file or build from file. Or use Function Mark in keymaps.
                 def fn_pressed_function(virtual_key_board: "VirtualKeyBoard"):
                     print("change to layer 1")
@@ -599,64 +800,48 @@ class VirtualKeyBoard:
                 virtual_key.pressed_function = partial(fn_pressed_function, self)
                 virtual_key.released_function = partial(fn_released_function, self)
             elif physical_key.key_name == "Q":
-                def ble_pressed_function(virtual_key_board: "VirtualKeyBoard", original_func: Callable = None):
-                    if virtual_key_board.layer == 1:
-                        virtual_key_board.set_connection_mode("bluetooth")
-                    elif original_func:
-                        original_func()
-                virtual_key.pressed_function = partial(ble_pressed_function, self, virtual_key.pressed_function)
+                virtual_key.layer_actions[1] = (keycode, partial(self.set_connection_mode, "bluetooth"), released_function)
             elif physical_key.key_name == "W":
-                def usb_pressed_function(virtual_key_board: "VirtualKeyBoard", original_func: Callable = None):
-                    if virtual_key_board.layer == 1:
-                        virtual_key_board.set_connection_mode("usb_hid")
-                    elif original_func:
-                        original_func()
-                virtual_key.pressed_function = partial(usb_pressed_function, self, virtual_key.pressed_function)
+                virtual_key.layer_actions[1] = (keycode, partial(self.set_connection_mode, "usb_hid"), released_function)
             elif physical_key.key_name == "E":
-                def debug_pressed_function(virtual_key_board: "VirtualKeyBoard", original_func: Callable = None):
-                    if virtual_key_board.layer == 1:
-                        virtual_key_board.set_connection_mode("debug")
-                    elif original_func:
-                        original_func()
-                virtual_key.pressed_function = partial(debug_pressed_function, self, virtual_key.pressed_function)
+                virtual_key.layer_actions[1] = (keycode, partial(self.set_connection_mode, "debug"), released_function)
             elif physical_key.key_name == "R":
-                def clear_ble_pressed_function(virtual_key_board: "VirtualKeyBoard", original_func: Callable = None):
-                    if virtual_key_board.layer == 1:
-                        if self.ble_interface:
-                            self.ble_interface.clear_paired_devices()
-                    elif original_func:
-                        original_func()
-                virtual_key.pressed_function = partial(clear_ble_pressed_function, self, virtual_key.pressed_function)
+                def clear_ble_pressed_function(virtual_key_board: "VirtualKeyBoard"):
+                    if virtual_key_board.ble_interface:
+                        virtual_key_board.ble_interface.clear_paired_devices()
+                virtual_key.layer_actions[1] = (keycode, partial(clear_ble_pressed_function, self), released_function)
 
     def bind_fn_layer_func(self, key_name: str, layer_id: int = 1, pressed_function: Optional[Callable] = None, released_function: Optional[Callable] = None):
+        layer_code = resolve_keycode(self.virtual_key_mappings["layers"][layer_id].get(key_name, None))
         for virtual_key in self.virtual_keys:
-            physical_key = virtual_key.bind_physical
-            layer_i_code_name = self.virtual_key_mappings["layers"][str(layer_id)].get(physical_key.key_name, None)
-            layer_codes = (virtual_key.keycode, getattr(KeyCode, layer_i_code_name, None) if layer_i_code_name is not None else None)
-            if physical_key.key_name == key_name:  # TODO: build a mapping dict
-                virtual_key.pressed_function = partial(fn_layer_pressed_function, self, virtual_key, layer_codes, pressed_function, virtual_key.pressed_function, layer_id=layer_id)
-                virtual_key.released_function = partial(fn_layer_released_function, self, virtual_key, layer_codes, released_function, virtual_key.released_function, layer_id=layer_id)
+            if virtual_key.bind_physical.key_name == key_name:  # TODO: build a mapping dict
+                virtual_key.layer_actions[layer_id] = (layer_code, pressed_function, released_function)
 
-    def scan(self, interval_us: int = 1, activate: bool = False):
+    def scan(self, interval_us: int = 0, activate: bool = False):
         if not self.phsical_key_board.scan(interval_us=interval_us, activate=activate):
             return
 
-        self.keystates.clear()
-        self.pressed_keys.clear()
-        virtual_keys = self.virtual_keys
-        for virtual_key in virtual_keys:
-            if virtual_key.pressed and virtual_key.keycode is not None:
-                self.pressed_keys.append(virtual_key)
-                # self.keystates.append(virtual_key.keycode)
-        self.pressed_keys.sort(key=lambda k:k.press_time, reverse=True)
-        self.keystates = [k.keycode for k in self.pressed_keys[:6]]  # TODO: Don't use list.
-        if self.keystates != self.prev_keystates:
-            self.prev_keystates.clear()
-            self.prev_keystates.extend(self.keystates)
+        # down_keys is kept newest first by VirtualKey.press/release, so the report is its first six keys with a keycode
+        keystates = self.keystates
+        n = 0
+        for virtual_key in self.down_keys:
+            keycode = virtual_key.keycode
+            if keycode is not None:  # A layer may still map the key to nothing
+                keystates[n] = keycode
+                n += 1
+                if n == 6:
+                    break
+        for i in range(n, self._pressed_len):
+            keystates[i] = 0
+        self._pressed_len = n
+        if n != self._prev_len or keystates != self.prev_keystates:
+            self.prev_keystates[:] = keystates
+            self._prev_len = n
+            down_keys = memoryview(keystates)[:n]
             if debugging():
-                print(self.keystates)
+                print(list(down_keys))
             if self.interface is not None:
-                self.interface.send_keys(self.keystates)
+                self.interface.send_keys(down_keys)
 
 
 class MusicKeyBoard(VirtualKeyBoard):
@@ -674,10 +859,11 @@ class MusicKeyBoard(VirtualKeyBoard):
             self.music_enabled = True
             self.music_mapping_path = music_mapping_path
             self.sampler = Sampler(note_wav_path)
-            self.music_mappings = json.load(open(self.music_mapping_path))
+            with open(self.music_mapping_path) as f:
+                self.music_mapping = json.load(f)[mode]  # The other modes are dropped right away
             self.mode = mode
-            self.music_mapping = self.music_mappings[mode]
-            key_config = json.load(open(key_config_path))
+            with open(key_config_path) as f:
+                key_config = json.load(f)
             sck_pin, ws_pin, sd_pin, en_pin = 48, 47, 45, 38
             if "i2s" in key_config:
                 sck_pin = key_config["i2s"].get("sck_pin", None)
@@ -702,22 +888,33 @@ class MusicKeyBoard(VirtualKeyBoard):
 
             self.note_key_mapping = {}
 
-            if note_cache_path is not None and not exists(note_cache_path):
-                makedirs(note_cache_path)
-            for i, note in enumerate(sorted(list(self.music_mapping.values()), key=lambda n: n[-1])):
+            cached_notes = set()
+            if note_cache_path is not None:
+                if exists(note_cache_path):
+                    cached_notes = set(entry[0] for entry in os.ilistdir(note_cache_path))  # One directory listing instead of a stat per note
+                else:
+                    makedirs(note_cache_path)
+            note_bytes = int(1.8 * self.sampler.rate) * 2
+            # Notes written to the cache are rendered into one shared buffer, only load_wav needs a buffer per note
+            render_buffer = bytearray(note_bytes) if note_cache_path is not None else None
+            for i, note in enumerate(sorted(self.music_mapping.values(), key=lambda n: n[-1])):
                 print(f"Loading {i} th note: {note}, alloc: {gc.mem_alloc()}, free: {gc.mem_free()}")
-                if note_cache_path is not None:
-                    if exists(f"{note_cache_path}/{note}"):
-                        wav_data = open(f"{note_cache_path}/{note}", "rb").read()
-                    else:
-                        wav_data = self.sampler.get_sample(note, duration=1.8).tobytes()
-                        with open(f"{note_cache_path}/{note}", "wb") as f:
-                            f.write(wav_data)
+                if note_cache_path is None:
+                    # Rendered straight into the buffer the note is played from, load_wav keeps a view of it
+                    wav_data = bytearray(note_bytes)
+                    num_bytes = self.sampler.render_into(note, wav_data, duration=1.8)
+                    self.audio_manager.load_wav(note, wav_data if num_bytes == note_bytes else memoryview(wav_data)[:num_bytes])
+                    wav_data = None
                 else:
-                    wav_data = self.sampler.get_sample(note, duration=1.8).tobytes()
-                self.audio_manager.load_wav(note, wav_data)
+                    if note not in cached_notes:
+                        num_bytes = self.sampler.render_into(note, render_buffer, duration=1.8)
+                        with open(f"{note_cache_path}/{note}", "wb") as f:
+                            f.write(memoryview(render_buffer)[:num_bytes])
+                    # Cached notes are streamed from flash when played instead of being kept in memory
+                    self.audio_manager.register_note_path(note, f"{note_cache_path}/{note}")
                 # micropython.mem_info()
                 gc.collect()
+            render_buffer = None
         else:
             self.music_enabled = False
             self.music_mapping_path = None
@@ -744,32 +941,34 @@ class MusicKeyBoard(VirtualKeyBoard):
         self.bind_fn_layer_func("M", pressed_function=self.enable_switch)
 
     def build_virtual_keys(self):
-        virtual_keys: List[VirtualKey] = []
+        # Sized for every physical slot up front and trimmed once, instead of growing with append
+        virtual_keys: List[VirtualKey] = [None] * len(self.phsical_key_board.physical_keys)
+        num_virtual_keys = 0
         for physical_key in self.phsical_key_board.physical_keys:
             if physical_key is not None:
                 key_code_name = physical_key.key_name
                 if self.virtual_key_mappings is not None:
-                    key_code_name = self.virtual_key_mappings["layers"]["0"].get(physical_key.key_name, None) or key_code_name
+                    key_code_name = self.virtual_key_mappings["layers"][0].get(physical_key.key_name, None) or key_code_name
                 if physical_key.key_name in self.music_mapping:
-                    self.note_key_mapping[self.music_mapping[physical_key.key_name]] = physical_key.key_name
+                    note = self.music_mapping[physical_key.key_name]
+                    self.note_key_mapping[note] = physical_key.key_name
                     virtual_key = VirtualKey(
                         key_name=key_code_name,
-                        keycode=getattr(KeyCode, key_code_name, None),
+                        keycode=resolve_keycode(key_code_name),
                         physical_key=physical_key,
                         pressed_function=None,
                         released_function=None,
                     )
-                    def pressed_function(virtual_key_board: "MusicKeyBoard", virtual_key: VirtualKey, note: str):
-                        if virtual_key_board.music_enabled:
-                            virtual_key.playing_wav_id = self.audio_manager.play_note(note)
-                    def released_function(virtual_key: VirtualKey):
-                        if hasattr(virtual_key, "playing_wav_id"):
-                            self.audio_manager.stop_note(wav_id=virtual_key.playing_wav_id, delay=500)
-                    virtual_key.pressed_function = partial(pressed_function, self, virtual_key, self.music_mapping[physical_key.key_name])
-                    virtual_key.released_function = partial(released_function, virtual_key)
+                    virtual_key.note = note
+                    virtual_key.playing_wav_id = -1  # Voice id of the sounding note, -1 when none
+                    virtual_key.pressed_function = partial(music_pressed_function, self, virtual_key)
+                    virtual_key.released_function = partial(music_released_function, self, virtual_key)
                 else:
-                    virtual_key = VirtualKey(key_name=key_code_name, keycode=getattr(KeyCode, key_code_name, None), physical_key=physical_key)
-                virtual_keys.append(virtual_key)
+                    virtual_key = VirtualKey(key_name=key_code_name, keycode=resolve_keycode(key_code_name), physical_key=physical_key)
+                virtual_keys[num_virtual_keys] = virtual_key
+                num_virtual_keys += 1
+        del virtual_keys[num_virtual_keys:]
         self.virtual_keys = virtual_keys
         self.build_fn_layer(virtual_keys)
+        self.index_keycode_keys(virtual_keys)
 
@@ -1,8 +1,13 @@
 import random
 import time
 
-from typing import Optional, Callable
-from utils import DEBUG
+from time import ticks_ms
+from micropython import const
+from typing import Optional, Callable, Dict, List, Tuple
+
+from utils import debug_log
+
+_DEBUG = const(0)  # Set to 1 to log presses of keys without a function with utils.debug_log, compiled out otherwise
 
 
 class VirtualKey:
@@ -24,6 +29,11 @@ class VirtualKey:
         self.press_time = None
         self.pressed = False
         self.update_time = time.time()
+        # Per layer (keycode, pressed_function, released_function), filled in by VirtualKeyBoard.build_fn_layer
+        self.layer_actions: Dict[int, Tuple[Optional[int], Optional[Callable], Optional[Callable]]] = {}
+        self.base_action: Optional[Tuple[Optional[int], Optional[Callable], Optional[Callable]]] = None
+        # Pressed keys of the owning keyboard, newest first, kept up to date by press() and release()
+        self.down_keys: Optional[List["VirtualKey"]] = None
 
         self.bind_physical_key(physical_key)
 
@@ -36,12 +46,12 @@ class VirtualKey:
         self.bind_physical = None
 
     def default_pressed_function(self):
-        if DEBUG:
-            print(f"virtual({self.keycode}, {self.key_name}) is pressed.")
+        if _DEBUG:
+            debug_log(f"virtual({self.keycode}, {self.key_name}) is pressed.")
 
     def default_released_function(self):
-        if DEBUG:
-            print(f"virtual({self.keycode}, {self.key_name}) is released.")
+        if _DEBUG:
+            debug_log(f"virtual({self.keycode}, {self.key_name}) is released.")
 
     # TODO: @property
     # def is_pressed(self):
@@ -50,8 +60,10 @@ class VirtualKey:
         # return pressed
 
     def press(self):
+        if self.down_keys is not None and not self.pressed:
+            self.down_keys.insert(0, self)
         self.pressed = True
-        self.press_time = time.ticks_ms()
+        self.press_time = ticks_ms()
         if self.pressed_function:
             pressed_function_result = self.pressed_function()
             if pressed_function_result is None:  # TODO
@@ -60,6 +72,8 @@ class VirtualKey:
         return None
         
     def release(self):
+        if self.down_keys is not None and self.pressed:
+            self.down_keys.remove(self)
         self.pressed = False
         if self.released_function:
             released_function_result = self.released_function()
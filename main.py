@@ -17,11 +17,10 @@ from st7789py import ST7789, color565
 import vga2_bold_16x32 as font
 
 from audio import AudioManager, Sampler, MIDIPlayer, midinumber_to_note, note_to_midinumber
-from graphics import interpolate
+from graphics import interpolate_int
 from bluetoothkeyboard import BluetoothKeyboard
 from utils import partial, exists, makedirs, check_disk_space
-from utils import DEBUG, debug_switch, debugging
-# from keys import VirtualKey, PhysicalKey
+from utils import DEBUG, debug_switch, debugging, flush_debug_log
 from keyboards import PhysicalKeyBoard, VirtualKeyBoard, MusicKeyBoard, LEDManager
 
 
@@ -31,7 +30,8 @@ class ScreenManager:  # TODO: global logger
         config_path = "/config/screen_config.json",
     ):
         if exists(config_path):
-            self.config = json.load(open(config_path))
+            with open(config_path) as f:
+                self.config = json.load(f)
 
             self.type: int = self.config.get("type", "ST7789")  # TODO: use for import driver
             physical_width: int = self.config.get("width", 135)
@@ -153,7 +153,7 @@ class ScreenManager:  # TODO: global logger
             start_row = i * height_division
             end_row = (i + 1) * height_division
             for row in range(start_row, end_row):
-                rgb_color = [0 if idx != i else int(interpolate(0, color_value, row - start_row, height_division)) for idx in range(3)]
+                rgb_color = [0 if idx != i else interpolate_int(0, color_value, row - start_row, height_division) for idx in range(3)]
                 color = color565(rgb_color)
 
             for row in range(start_row, end_row):
@@ -188,9 +188,7 @@ def main():
     start_time = time.ticks_ms()
     current_time = time.ticks_ms()
 
-    for i in range(virtual_key_board.phsical_key_board.led_manager.led_pixels):
-        virtual_key_board.phsical_key_board.led_manager.set_pixel(i, (0, 0, 0))
-        virtual_key_board.phsical_key_board.led_manager.write_pixels()
+    virtual_key_board.phsical_key_board.led_manager.fill_clamped((0, 0, 0), write=True)
 
     for i in range(virtual_key_board.phsical_key_board.led_manager.led_pixels):
         virtual_key_board.phsical_key_board.led_manager.set_pixel(i, (1, 1, 1), write=True)
@@ -245,9 +243,13 @@ def main():
         midi_player.play(play_func)
         screen_manager.step_animate(texts=texts)
         if count % 8 == 0:
-            virtual_key_board.scan(1, activate=True)
+            virtual_key_board.scan(activate=True)
         else:
-            virtual_key_board.scan(1)
+            virtual_key_board.scan()
+        if count % 256 == 0 and virtual_key_board.ble_interface is not None:
+            virtual_key_board.ble_interface.flush_paired_devices()  # Bonding secrets are saved outside the BLE IRQ
+        if count % 64 == 0:
+            flush_debug_log()  # Lines queued by debug_log during the scans, written in one go
         # virtual_key_board.phsical_key_board.scan(0)
         # virtual_key_board.phsical_key_board.scan_keys(0)
         # max_scan_gap = max(max_scan_gap, time.ticks_ms() - scan_start_time)
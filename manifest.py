@@ -0,0 +1,7 @@
+# Freeze the modules imported at boot into a custom firmware build, e.g.
+#   make BOARD=ESP32_GENERIC_S3 FROZEN_MANIFEST=/path/to/MicroKeyBoard/manifest.py
+include("$(PORT_DIR)/boards/manifest.py")
+
+module("constants.py", opt=3)
+module("ble_common.py", opt=3)
+module("bluetoothkeyboard.py", opt=3)
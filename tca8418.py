@@ -168,6 +168,9 @@ class TCA8418:
         )
 
 
+        # keep register auto-increment off (CFG bit 7), read_events_batch relies on every read of KEY_EVENT_A popping the FIFO
+        self.set_auto_increment(False)
+
         # read in event queue to clear any pending events from powerup
         # print(self.get_events_count(), "events") # for debugging
         while self.get_events_count() > 0:
@@ -199,6 +202,9 @@ class TCA8418:
     def clear_key_int(self) -> None: self._set_reg_bit(_TCA8418_REG_INTSTAT, 0, True) # Write 1 to clear
 
     # CONFIG register bits (Read/Write)
+    def get_auto_increment(self) -> bool: return self._get_reg_bit(_TCA8418_REG_CONFIG, 7)
+    def set_auto_increment(self, value: bool) -> None: self._set_reg_bit(_TCA8418_REG_CONFIG, 7, value)
+
     def get_gpi_event_while_locked(self) -> bool: return self._get_reg_bit(_TCA8418_REG_CONFIG, 6)
     def set_gpi_event_while_locked(self, value: bool) -> None: self._set_reg_bit(_TCA8418_REG_CONFIG, 6, value)
 
@@ -227,6 +233,14 @@ class TCA8418:
         # Read from the KEYEVENT register (FIFO)
         return self._read_reg(_TCA8418_REG_KEYEVENT)
 
+    def read_events_batch(self, n: int) -> bytes:
+        """Read n key events from the FIFO in one I2C transaction. Auto-increment is off, so each byte of the burst re-reads KEY_EVENT_A, which pops one event"""
+        try:
+            return self._i2c.readfrom_mem(self._addr, _TCA8418_REG_KEYEVENT, n)
+        except OSError as e:
+            print("I2C read error:", e)
+            return b''
+
     # Helper methods to access bits across GPIODATSTAT/OUT, INTEN, KPGPIO, etc.
     # These map a pin number (0-17) to the correct register (base + pin//8)
     # and bit offset (pin%8).
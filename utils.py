@@ -1,4 +1,5 @@
 import os
+import sys
 
 
 DEBUG = False
@@ -17,6 +18,38 @@ def debugging() -> bool:
     return DEBUG
 
 
+_debug_log_buf = None  # Allocated by the first debug_log call, so builds without debug output do not pay for it
+_debug_log_len = 0
+_debug_log_dropped = 0
+
+
+def debug_log(msg: str, size: int = 2048):
+    """Queues a debug line for flush_debug_log instead of printing it from a hot loop, lines that do not fit are dropped."""
+    global _debug_log_buf, _debug_log_len, _debug_log_dropped
+    if _debug_log_buf is None:
+        _debug_log_buf = bytearray(size)
+    data = msg.encode()
+    end = _debug_log_len + len(data) + 1
+    if end > len(_debug_log_buf):
+        _debug_log_dropped += 1
+        return
+    _debug_log_buf[_debug_log_len:end - 1] = data
+    _debug_log_buf[end - 1] = 10  # '\n'
+    _debug_log_len = end
+
+
+def flush_debug_log():
+    """Writes the queued debug lines with a single write."""
+    global _debug_log_len, _debug_log_dropped
+    if not _debug_log_len:
+        return
+    sys.stdout.write(memoryview(_debug_log_buf)[:_debug_log_len])
+    _debug_log_len = 0
+    if _debug_log_dropped:
+        print(f"{_debug_log_dropped} debug lines dropped")
+        _debug_log_dropped = 0
+
+
 def exists(path: str) -> bool:
     try: os.stat(path); return True
     except OSError: return False